@@ -2,8 +2,11 @@ import logging
 logging.basicConfig(level = logging.INFO,format = '%(asctime)s - %(name)s - %(levelname)s \n %(message)s \n')
 logger = logging.getLogger()
 
+import io
 import os
+import time
 import fire
+import threading
 import traceback
 import re
 import json
@@ -13,9 +16,25 @@ import pyaudio
 import audioop
 import httpx
 import websockets
-from openai import OpenAI
+import soundfile
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
 import asyncio
-from multiprocessing import Process, Pipe, SimpleQueue
+from multiprocessing import Process, SimpleQueue
+
+from shmring import AudioRing
+from context import ContextManager
+from segmenter import SentenceSegmenter
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 FORMAT = pyaudio.paInt16
@@ -24,6 +43,13 @@ CHUNK = 1024
 INPUT_RATE = 16000
 OUTPUT_RATE = 22050
 
+# 进程间音频环形缓冲区的容量 (s)
+RECORD_BUFFER_TIME = 2       # 录音 -> STT，满载时丢弃新录到的音频
+PLAY_BUFFER_TIME = 2         # TTS -> 播放，满载时 TTS 等待播放
+
+# 每次读写的字节数
+CHUNK_BYTES = CHUNK*CHANNELS*2
+
 
 class Recorder:
 
@@ -42,13 +68,14 @@ class Recorder:
             stream.close()
             audio.terminate()
 
-    def run(self, pipe_from_stt):
+    def run(self, ring_to_stt):
         try:
             audio = pyaudio.PyAudio()
             stream = audio.open(format = FORMAT, channels = CHANNELS, rate = INPUT_RATE, frames_per_buffer = CHUNK, input = True)
             while True:
                 data = stream.read(CHUNK)
-                pipe_from_stt.send(data)
+                if not ring_to_stt.write(data):
+                    logger.warning(f"[Recorder] Overrun: {ring_to_stt.stats()}")
         except Exception as e:
             print(f"[Recorder] Error: {e}")
             traceback.print_exc()
@@ -60,12 +87,12 @@ class Recorder:
 
 class Player:
 
-    def run(self, pipe_from_tts):
+    def run(self, ring_from_tts):
         try:
             audio = pyaudio.PyAudio()
             stream = audio.open(format = FORMAT, channels = CHANNELS, rate = OUTPUT_RATE, frames_per_buffer = CHUNK, output = True)
             while True:
-                data = pipe_from_tts.recv()
+                data = ring_from_tts.read(CHUNK_BYTES, min_size = 2)
                 stream.write(data)
         except Exception as e:
             print(f"[Player] Error: {e}")
@@ -76,6 +103,38 @@ class Player:
             audio.terminate()
 
 
+class AudioEncoder:
+
+    def __init__(self, codec = "pcm", sample_rate = INPUT_RATE, channels = CHANNELS):
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.channels = channels
+        if codec == "opus":
+            if opuslib is None:
+                raise Exception("opus codec requires opuslib!")
+            self.encoder = opuslib.Encoder(sample_rate, channels, opuslib.APPLICATION_VOIP)
+            self.frame_size = sample_rate//50 # Opus 帧长 20 ms
+            self.buffer = b""
+        elif codec not in ["pcm", "flac"]:
+            raise Exception(f"Unsupported codec: {codec}")
+
+    def encode(self, data):
+        if self.codec == "opus":
+            self.buffer += data
+            frame_bytes = self.frame_size*self.channels*2
+            packets = []
+            while len(self.buffer) >= frame_bytes:
+                packets.append(self.encoder.encode(self.buffer[: frame_bytes], self.frame_size))
+                self.buffer = self.buffer[frame_bytes: ]
+            return packets
+        if self.codec == "flac":
+            samples = np.frombuffer(data, dtype = np.int16).reshape(-1, self.channels)
+            buffer = io.BytesIO()
+            soundfile.write(buffer, samples, self.sample_rate, format = "FLAC", subtype = "PCM_16")
+            return [buffer.getvalue()]
+        return [data]
+
+
 class STTClient:
 
     def __init__(self, config):
@@ -86,35 +145,54 @@ class STTClient:
             self.params_url += f"&{key}={value}"
         self.stop_at_vad_start = config.get("speaker_verify") is not None
         self.recoder = Recorder()
+        self.encoder = AudioEncoder(config.get("codec", "pcm"))
 
-    async def send_audio(self, websocket, pipe_from_recoder):
+    async def send_audio(self, websocket, ring_from_recoder):
         while True:
-            data = pipe_from_recoder.recv()
-            await websocket.send(data)
+            data = await asyncio.to_thread(ring_from_recoder.read, CHUNK_BYTES)
+            for packet in self.encoder.encode(data):
+                await websocket.send(packet)
             await asyncio.sleep(0)
 
+    def parse(self, data):
+        # 兼容 protocol=0 的 "[VAD Start]" 标记与结果 JSON，以及 protocol=1 的类型化消息
+        if data == "[VAD Start]":
+            return {"type": "vad_start"}
+        if isinstance(data, bytes):
+            if msgpack is None:
+                raise Exception("msgpack encoding requires msgpack!")
+            msg = msgpack.unpackb(data, raw = False)
+        else:
+            msg = json.loads(data)
+        if "type" not in msg:
+            msg["type"] = "partial" if msg.get("partial") else "final"
+        return msg
+
     async def receive_text(self, websocket, queue_to_llm):
         while True:
             data = await websocket.recv()
             logger.info(f"[STT] {data}")
-            if data == "[VAD Start]":
+            msg = self.parse(data)
+            if msg["type"] == "vad_start":
                 if self.stop_at_vad_start:
                     queue_to_llm.put("") # then LLM will send Stop signal to TTS
-            else:
-                text = json.loads(data)["text"]
+            elif msg["type"] == "final":
+                if msg.get("revision", 0) > 0: # 纠错后的后续消息不送入 LLM
+                    continue
+                text = msg["text"]
                 if text:
                     queue_to_llm.put(text)
 
-    async def stt(self, pipe_from_recoder, queue_to_llm):
+    async def stt(self, ring_from_recoder, queue_to_llm):
         async with websockets.connect(self.params_url) as websocket:
             await asyncio.gather(
-                self.send_audio(websocket, pipe_from_recoder), 
+                self.send_audio(websocket, ring_from_recoder), 
                 self.receive_text(websocket, queue_to_llm)
             )
 
-    def run(self, pipe_from_recoder, queue_to_llm):
+    def run(self, ring_from_recoder, queue_to_llm):
         try:
-            asyncio.run(self.stt(pipe_from_recoder, queue_to_llm))
+            asyncio.run(self.stt(ring_from_recoder, queue_to_llm))
         except Exception as e:
             print(f"[STT] Error: {e}")
             traceback.print_exc()
@@ -129,26 +207,28 @@ class LLMClient:
         self.temperature = config.get("temperature", 1.0)
         self.max_tokens = config.get("max_tokens", 128)
         self.system = config.get("system")
-        if self.system:
-            self.messages = [{"role": "system", "content": self.system}]
-        else:
-            self.messages = []
+        self.segmenter_config = config.get("segmenter", {})
         self.client = OpenAI(base_url = self.base_url, api_key = self.api_key)
-
-    def cut_sentence(self, prefix, delta):
-        stops = ['．', '！', '？', '｡', '。', '?', '!', '~', '—', '…', '...', '\n', '\r']
-        if delta:
-            pos = -1
-            for char in stops:
-                pos = max(pos, delta.rfind(char))
-            if pos >= 0:
-                sent = prefix + delta[: pos+1]
-                prefix = delta[pos+1: ]
-            else:
-                sent = None
-                prefix += delta
-        else: sent = None
-        return sent, prefix
+        # 异步流式：新的用户输入立即取消进行中的生成，连接池在多轮之间保持长连接
+        self.async_stream = config.get("async_stream", True)
+        self.http_client = httpx.AsyncClient(
+            limits = httpx.Limits(max_connections = config.get("max_connections", 4), 
+                                  max_keepalive_connections = config.get("max_connections", 4), 
+                                  keepalive_expiry = config.get("keepalive_expiry", 60)), 
+            timeout = httpx.Timeout(None, connect = 10))
+        self.async_client = AsyncOpenAI(base_url = self.base_url, api_key = self.api_key, http_client = self.http_client)
+        self.cancel_stats = {"count": 0, "total": 0., "max": 0.}
+        # 对话历史控制在 token 预算内，较早的轮次在后台压缩为摘要
+        self.summary_tokens = config.get("summary_tokens", 256)
+        self.context = ContextManager(
+            system = self.system, budget = config.get("context_budget", 3000), 
+            keep_messages = config.get("keep_messages", 8), 
+            summarize = self.summarize if config.get("summarize", True) else None, 
+            summary_tokens = self.summary_tokens, tokenizer = config.get("tokenizer"))
+
+    def segmenter(self, ):
+        # 每次回复使用新的切分器
+        return SentenceSegmenter(**self.segmenter_config)
 
     def llm(self, queue_from_stt, queue_from_tts, queue_to_tts):
         user = ""
@@ -160,36 +240,122 @@ class LLMClient:
             while not queue_from_tts.empty():
                 assistant += queue_from_tts.get()
             if assistant:
-                self.messages.append({"role": "assistant", "content": assistant})
-            self.messages.append({"role": "user", "content": user})
+                self.context.append("assistant", assistant)
+            self.context.append("user", user)
             logger.info(f"[LLM] User: {user}")
             user = ""
             request = self.client.chat.completions.create(
-                model = self.model, messages = self.messages, 
+                model = self.model, messages = self.context.messages(), 
                 temperature = self.temperature, max_tokens = self.max_tokens, 
                 stream = True)
             if not queue_from_stt.empty():
                 queue_to_tts.put(None)
                 request.response.close()
                 continue
-            prefix = ""
+            segmenter = self.segmenter()
             for chunk in request:
                 if not queue_from_stt.empty():
                     queue_to_tts.put(None)
                     request.response.close()
                     break
                 delta = chunk.choices[0].delta.content
-                sent, prefix = self.cut_sentence(prefix, delta)
-                if sent:
+                for sent in segmenter.push(delta):
+                    logger.info(f"[LLM] Sent: {sent}")
+                    queue_to_tts.put(sent)
+            else:
+                prefix = segmenter.flush()
+                if prefix:
+                    logger.info(f"[LLM] Prefix: {prefix}")
+                    queue_to_tts.put(prefix)
+
+    async def stream(self, messages):
+        request = await self.async_client.chat.completions.create(
+            model = self.model, messages = messages, 
+            temperature = self.temperature, max_tokens = self.max_tokens, 
+            stream = True)
+        try:
+            async for chunk in request:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # 被取消时关闭 HTTP 流，服务端随之中止生成
+            await request.close()
+
+    async def summarize(self, messages):
+        # 供 ContextManager 在后台调用，不与回复共用取消
+        response = await self.async_client.chat.completions.create(
+            model = self.model, messages = messages, 
+            temperature = 0.3, max_tokens = self.summary_tokens)
+        return response.choices[0].message.content.strip()
+
+    async def cancel(self, task, interrupt_time):
+        # 取消进行中的回复，记录从收到打断到连接关闭的耗时
+        if task is None or task.done():
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions = True)
+        latency = time.perf_counter()-interrupt_time
+        stats = self.cancel_stats
+        stats["count"] += 1
+        stats["total"] += latency
+        stats["max"] = max(stats["max"], latency)
+        logger.info(f"[LLM] Cancelled in {latency*1000:.1f} ms "
+                    f"(avg {stats['total']/stats['count']*1000:.1f} ms, max {stats['max']*1000:.1f} ms)")
+
+    async def reply(self, queue_to_tts):
+        try:
+            segmenter = self.segmenter()
+            async for delta in self.stream(self.context.messages()):
+                for sent in segmenter.push(delta):
                     logger.info(f"[LLM] Sent: {sent}")
                     queue_to_tts.put(sent)
+            prefix = segmenter.flush()
             if prefix:
                 logger.info(f"[LLM] Prefix: {prefix}")
                 queue_to_tts.put(prefix)
+        except Exception as e:
+            print(f"[LLM] Error: {e}")
+            traceback.print_exc()
+
+    async def llm_async(self, queue_from_stt, queue_from_tts, queue_to_tts):
+        loop = asyncio.get_running_loop()
+        texts = asyncio.Queue()
+
+        def bridge():
+            # 在线程中阻塞读取进程间队列，收到即唤醒事件循环
+            while True:
+                text = queue_from_stt.get()
+                loop.call_soon_threadsafe(texts.put_nowait, (time.perf_counter(), text))
+
+        threading.Thread(target = bridge, daemon = True).start()
+        turn = None
+        try:
+            while True:
+                interrupt_time, user = await texts.get()
+                queue_to_tts.put(None)
+                await self.cancel(turn, interrupt_time)
+                while not texts.empty():
+                    user += texts.get_nowait()[1]
+                    queue_to_tts.put(None)
+                if not user:
+                    continue
+                assistant = ""
+                while not queue_from_tts.empty():
+                    assistant += queue_from_tts.get()
+                if assistant:
+                    self.context.append("assistant", assistant)
+                self.context.append("user", user)
+                logger.info(f"[LLM] User: {user}")
+                turn = asyncio.create_task(self.reply(queue_to_tts))
+        finally:
+            await self.http_client.aclose()
 
     def run(self, queue_from_stt, queue_from_tts, queue_to_tts):
         try:
-            self.llm(queue_from_stt, queue_from_tts, queue_to_tts)
+            if self.async_stream:
+                asyncio.run(self.llm_async(queue_from_stt, queue_from_tts, queue_to_tts))
+            else:
+                self.llm(queue_from_stt, queue_from_tts, queue_to_tts)
         except Exception as e:
             print(f"[LLM] Error: {e}")
             traceback.print_exc()
@@ -246,7 +412,7 @@ class TTSClient:
             else: return False, []
         return True, sents
 
-    async def tts(self, queue_from_llm, queue_to_llm, pipe_to_player):
+    async def tts(self, queue_from_llm, queue_to_llm, ring_to_player):
         sents = []
         while True:
             while not queue_from_llm.empty() or len(sents) == 0:
@@ -256,13 +422,15 @@ class TTSClient:
             grouped_sents, cleaned_sents, sents = self.group_sents(sents)
             responses = await self.requests(cleaned_sents)
             continue_tts, sents = self.check(sents, queue_from_llm)
+            if not continue_tts:
+                ring_to_player.discard()
             for grouped_sent, cleaned_sent, response in zip(grouped_sents, cleaned_sents, responses):
                 if continue_tts:
                     logger.info(f"[TTS] Start: {grouped_sent}")
                     async for chunk in response.aiter_bytes(chunk_size = CHUNK):
                         continue_tts, sents = self.check(sents, queue_from_llm)
                         if continue_tts:
-                            pipe_to_player.send(chunk)
+                            ring_to_player.write(chunk, block = True)
                             new_grouped_sents, new_cleaned_sents, sents = self.group_sents(sents)
                             if len(new_cleaned_sents) > 0:
                                 new_responses = await self.requests(new_cleaned_sents)
@@ -271,33 +439,34 @@ class TTSClient:
                                 responses.extend(new_responses)
                         else:
                             logger.info(f"[TTS] Break: {grouped_sent}")
+                            ring_to_player.discard() # 打断时已缓冲但未播放的音频不再播放
                             break
                     else:
                         logger.info(f"[TTS] Finished: {grouped_sent}")
                         queue_to_llm.put(grouped_sent)
                 await response.aclose()
 
-    def run(self, queue_from_llm, queue_to_llm, pipe_to_player):
+    def run(self, queue_from_llm, queue_to_llm, ring_to_player):
         try:
-            asyncio.run(self.tts(queue_from_llm, queue_to_llm, pipe_to_player))
+            asyncio.run(self.tts(queue_from_llm, queue_to_llm, ring_to_player))
         except Exception as e:
             print(f"[TTS] Error: {e}")
             traceback.print_exc()
 
 
-def run_recorder(pipe_to_stt):
+def run_recorder(ring_to_stt):
     recorder = Recorder()
-    recorder.run(pipe_to_stt)
+    recorder.run(ring_to_stt)
 
 
-def run_player(pipe_from_tts):
+def run_player(ring_from_tts):
     player = Player()
-    player.run(pipe_from_tts)
+    player.run(ring_from_tts)
 
 
-def run_stt(config, pipe_from_recoder, queue_to_llm):
+def run_stt(config, ring_from_recoder, queue_to_llm):
     stt = STTClient(config)
-    stt.run(pipe_from_recoder, queue_to_llm)
+    stt.run(ring_from_recoder, queue_to_llm)
 
 
 def run_llm(config, queue_from_stt, queue_from_tts, queue_to_tts):
@@ -305,9 +474,9 @@ def run_llm(config, queue_from_stt, queue_from_tts, queue_to_tts):
     llm.run(queue_from_stt, queue_from_tts, queue_to_tts)
 
 
-def run_tts(config, queue_from_llm, queue_to_llm, pipe_to_player):
+def run_tts(config, queue_from_llm, queue_to_llm, ring_to_player):
     tts = TTSClient(config)
-    tts.run(queue_from_llm, queue_to_llm, pipe_to_player)
+    tts.run(queue_from_llm, queue_to_llm, ring_to_player)
 
 
 def main(config_path):
@@ -316,21 +485,26 @@ def main(config_path):
         config = json.load(f)
     logger.info(json.dumps(config, ensure_ascii = False, indent = 2))
     logger.info("*"*50)
-    pipe_from_recoder_to_stt = Pipe()
-    pipe_from_tts_to_player = Pipe()
+    # 音频经共享内存传递，文本仍然使用队列
+    ring_from_recoder_to_stt = AudioRing(RECORD_BUFFER_TIME*INPUT_RATE*CHANNELS*2)
+    ring_from_tts_to_player = AudioRing(PLAY_BUFFER_TIME*OUTPUT_RATE*CHANNELS*2)
     queue_from_stt_to_llm = SimpleQueue()
     queue_from_llm_to_tts = SimpleQueue()
     queue_from_tts_to_llm = SimpleQueue()
-    p1 = Process(target = run_recorder, args = (pipe_from_recoder_to_stt[0], ))
-    p2 = Process(target = run_player, args = (pipe_from_tts_to_player[1], ))
-    p3 = Process(target = run_stt, args = (config["stt"], pipe_from_recoder_to_stt[1], queue_from_stt_to_llm))
+    p1 = Process(target = run_recorder, args = (ring_from_recoder_to_stt, ))
+    p2 = Process(target = run_player, args = (ring_from_tts_to_player, ))
+    p3 = Process(target = run_stt, args = (config["stt"], ring_from_recoder_to_stt, queue_from_stt_to_llm))
     p4 = Process(target = run_llm, args = (config["llm"], queue_from_stt_to_llm, queue_from_tts_to_llm, queue_from_llm_to_tts))
-    p5 = Process(target = run_tts, args = (config["tts"], queue_from_llm_to_tts, queue_from_tts_to_llm, pipe_from_tts_to_player[0]))
+    p5 = Process(target = run_tts, args = (config["tts"], queue_from_llm_to_tts, queue_from_tts_to_llm, ring_from_tts_to_player))
     processes = [p1, p2, p3, p4, p5]
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join()
+    try:
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+    finally:
+        ring_from_recoder_to_stt.close()
+        ring_from_tts_to_player.close()
 
 
 if __name__ == "__main__":
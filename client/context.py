@@ -0,0 +1,153 @@
+import re
+import asyncio
+import logging
+import traceback
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+
+logger = logging.getLogger()
+
+
+SUMMARY_HEADER = "以下是之前对话的摘要："
+
+SUMMARY_PROMPT = (
+    "你负责压缩一段语音对话的历史记录。请结合已有摘要与新增的对话，"
+    "用对话所使用的语言写出一份简洁的摘要，保留用户的身份、需求、已确认的事实与尚未解决的问题，"
+    "不要编造内容，只输出摘要本身。"
+)
+
+MESSAGE_OVERHEAD = 4         # 每条消息的角色与分隔符大约占用的 token 数
+
+
+class TokenCounter:
+
+    # 有分词器时精确计数，否则按中文每字 1 个、其它字符每 4 个 1 个估计（偏保守）
+    def __init__(self, tokenizer = None):
+        self.tokenizer = None
+        if tokenizer:
+            if AutoTokenizer is None:
+                raise Exception("tokenizer requires transformers!")
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens = False))
+        cjk = len(re.findall(r"[⺀-鿿豈-﫿＀-￯]", text))
+        return cjk+(len(text)-cjk+3)//4
+
+
+def summary_request(summary, messages):
+    # 生成摘要请求的消息列表
+    lines = []
+    if summary:
+        lines.append(f"已有摘要：\n{summary}\n")
+    lines.append("新增对话：")
+    for message in messages:
+        role = "用户" if message["role"] == "user" else "助手"
+        lines.append(f"{role}：{message['content']}")
+    return [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": "\n".join(lines)}]
+
+
+class ContextManager:
+
+    # 将对话历史控制在 token 预算内：
+    # - 系统提示与最近 keep_messages 条消息固定保留
+    # - 超过 compact_ratio*budget 时，将更早的消息整块压缩为摘要（后台调用 LLM），或在无法摘要时整块丢弃
+    # - 压缩后历史降到 target_ratio*budget 以下，此后多轮请求的前缀保持不变，服务端的前缀缓存可以持续命中
+    def __init__(self, system = None, budget = 3000, keep_messages = 8, compact_ratio = 0.8, target_ratio = 0.5,
+                 summarize = None, summary_tokens = 256, tokenizer = None):
+        self.system = system
+        self.budget = budget
+        self.keep_messages = keep_messages
+        self.compact_ratio = compact_ratio
+        self.target_ratio = target_ratio
+        self.summarize = summarize          # async summarize(messages) -> str，None 表示直接丢弃
+        self.summary_tokens = summary_tokens
+        self.counter = TokenCounter(tokenizer)
+        self.summary = ""
+        self.history = []                   # [(message, tokens)]
+        self.task = None                    # 进行中的后台摘要
+
+    def prefix(self, ):
+        content = self.system or ""
+        if self.summary:
+            content = f"{content}\n\n{SUMMARY_HEADER}\n{self.summary}".strip()
+        if not content:
+            return []
+        return [{"role": "system", "content": content}]
+
+    def prefix_tokens(self, ):
+        return sum(self.counter.count(message["content"])+MESSAGE_OVERHEAD for message in self.prefix())
+
+    def tokens(self, ):
+        return self.prefix_tokens()+sum(tokens for _, tokens in self.history)
+
+    def append(self, role, content):
+        self.history.append(({"role": role, "content": content}, self.counter.count(content)+MESSAGE_OVERHEAD))
+        if self.tokens() > self.compact_ratio*self.budget:
+            self.compact()
+
+    def block(self, ):
+        # 从最早的消息开始，选出需要压缩的一整块，使剩余部分降到目标以下；最近的消息不参与
+        limit = max(len(self.history)-self.keep_messages, 0)
+        target = self.target_ratio*self.budget-self.prefix_tokens()-self.summary_tokens
+        total = sum(tokens for _, tokens in self.history)
+        n = 0
+        while n < limit and total > target:
+            total -= self.history[n][1]
+            n += 1
+        # 不在用户消息之前截断，保证剩余历史以用户消息开始
+        while n < limit and self.history[n][0]["role"] != "user":
+            n += 1
+        return n
+
+    def compact(self, ):
+        if self.task is not None and not self.task.done():
+            return
+        n = self.block()
+        if n == 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self.summarize is None or loop is None:
+            self.drop(n)
+            return
+        messages = [message for message, _ in self.history[: n]]
+        self.task = loop.create_task(self.compact_async(messages, n))
+
+    async def compact_async(self, messages, n):
+        try:
+            summary = await self.summarize(summary_request(self.summary, messages))
+        except Exception as e:
+            logger.error(f"[Context] Summarize error: {e}")
+            traceback.print_exc()
+            summary = None
+        # 摘要期间新增的消息都在末尾，前 n 条仍是被压缩的那一块
+        if summary:
+            self.summary = summary
+            self.history = self.history[n: ]
+            logger.info(f"[Context] Summarized {n} messages, {self.tokens()} tokens")
+        else:
+            self.drop(n)
+
+    def drop(self, n):
+        self.history = self.history[n: ]
+        logger.info(f"[Context] Dropped {n} messages, {self.tokens()} tokens")
+
+    def messages(self, ):
+        # 摘要未完成时历史可能暂时超出预算，此时临时截掉最早的消息（不修改历史，前缀也不变）
+        history = [message for message, _ in self.history]
+        total = self.tokens()
+        k = 0
+        while total > self.budget and k < len(self.history)-1:
+            total -= self.history[k][1]
+            k += 1
+        return self.prefix()+history[k: ]
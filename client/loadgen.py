@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import random
+import asyncio
+
+import fire
+import soundfile
+import numpy as np
+import websockets
+from urllib.parse import urlencode
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+CHANNELS = 1
+CHUNK = 1024
+INPUT_RATE = 16000
+SILENCE_TIME = 1.            # 每个文件之后补充的静音长度 (s)
+
+# 每次发送的字节数，与 Recorder 的分包一致
+CHUNK_BYTES = CHUNK*CHANNELS*2
+
+# 随机选择的查询参数，None 表示不携带该参数
+PARAM_CHOICES = {
+    "language_check": ["true", "false"],
+    "use_itn": ["true", "false"],
+    "add_punctuations": ["true", "false"],
+    "use_corrector": ["true", "false"]
+}
+
+
+def load_audios(wav_dir):
+    audios = []
+    for file in sorted(os.listdir(wav_dir)):
+        if os.path.splitext(file)[1].lower() not in [".wav", ".flac"]:
+            continue
+        data, sample_rate = soundfile.read(os.path.join(wav_dir, file), dtype = "int16", always_2d = True)
+        if sample_rate != INPUT_RATE:
+            raise Exception(f"{file}: sample rate must be {INPUT_RATE}, got {sample_rate}")
+        silence = np.zeros(int(SILENCE_TIME*INPUT_RATE), dtype = np.int16)
+        audios.append((data[:, 0].tobytes(), silence.tobytes()))
+    if len(audios) == 0:
+        raise Exception(f"No audio found in {wav_dir}!")
+    return audios
+
+
+def parse(data):
+    # 兼容 protocol=0 与 protocol=1
+    if data == "[VAD Start]":
+        return {"type": "vad_start"}
+    if isinstance(data, bytes):
+        msg = msgpack.unpackb(data, raw = False)
+    else:
+        msg = json.loads(data)
+    if "type" not in msg:
+        msg["type"] = "partial" if msg.get("partial") else "final"
+    return msg
+
+
+def random_params(choices, fixed):
+    params = {}
+    for key, values in choices.items():
+        value = random.choice(values)
+        if value is not None:
+            params[key] = value
+    params.update(fixed)
+    return params
+
+
+class LoadSession:
+
+    def __init__(self, index, url, params, audios, loops):
+        self.index = index
+        self.url = url+"?"+urlencode(params) if params else url
+        self.params = params
+        self.audios = audios
+        self.loops = loops
+        self.connect_time = None
+        self.files = []     # 每个文件的 (开始发送时间, 语音发送完毕时间)
+        self.events = []    # (接收时间, 消息类型)
+        self.error = None
+
+    async def send(self, websocket):
+        packet_time = CHUNK/INPUT_RATE
+        start_time = time.monotonic()
+        sent = 0
+        for _ in range(self.loops):
+            for speech, silence in self.audios:
+                file_start = time.monotonic()
+                for audio, is_speech in [(speech, True), (silence, False)]:
+                    for k in range(0, len(audio), CHUNK_BYTES):
+                        await websocket.send(audio[k: k+CHUNK_BYTES])
+                        sent += 1
+                        delay = start_time+sent*packet_time-time.monotonic()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    if is_speech:
+                        self.files.append((file_start, time.monotonic()))
+
+    async def receive(self, websocket):
+        async for data in websocket:
+            msg = parse(data)
+            if msg["type"] == "final" and msg.get("revision", 0) > 0:
+                continue
+            self.events.append((time.monotonic(), msg["type"]))
+
+    async def run(self, drain_time):
+        try:
+            start_time = time.monotonic()
+            async with websockets.connect(self.url, max_size = None) as websocket:
+                self.connect_time = time.monotonic()-start_time
+                receiver = asyncio.create_task(self.receive(websocket))
+                try:
+                    await self.send(websocket)
+                    await asyncio.sleep(drain_time)
+                finally:
+                    receiver.cancel()
+                    await asyncio.gather(receiver, return_exceptions = True)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+
+    def latencies(self, ):
+        # 每个文件：开始发送到首个 vad_start 的时间，语音发送完毕到首个 final 的时间
+        vad_starts, finals = [], []
+        for k, (file_start, speech_end) in enumerate(self.files):
+            next_start = self.files[k+1][0] if k+1 < len(self.files) else float("inf")
+            for t, type in self.events:
+                if type == "vad_start" and file_start <= t < next_start:
+                    vad_starts.append(t-file_start)
+                    break
+            for t, type in self.events:
+                if type == "final" and speech_end <= t:
+                    finals.append(t-speech_end)
+                    break
+        return vad_starts, finals
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    return {f"p{q}": round(float(np.percentile(values, q))*1000, 1) for q in [50, 90, 99]}
+
+
+async def load(url, audios, sessions, ramp, loops, choices, fixed, drain_time):
+    runners = [LoadSession(k, url, random_params(choices, fixed), audios, loops) for k in range(sessions)]
+    tasks = []
+    start_time = time.monotonic()
+    for runner in runners:
+        tasks.append(asyncio.create_task(runner.run(drain_time)))
+        if ramp > 0:
+            await asyncio.sleep(1/ramp)
+    await asyncio.gather(*tasks)
+    wall_seconds = time.monotonic()-start_time
+    connects = [runner.connect_time for runner in runners if runner.connect_time is not None]
+    vad_starts, finals = [], []
+    for runner in runners:
+        s, f = runner.latencies()
+        vad_starts.extend(s)
+        finals.extend(f)
+    errors = [runner.error for runner in runners if runner.error]
+    audio_seconds = sum(len(speech)+len(silence) for speech, silence in audios)*loops/2/INPUT_RATE
+    utterances = sum(1 for runner in runners for _, type in runner.events if type == "final")
+    return {
+        "sessions": sessions,
+        "wall_seconds": round(wall_seconds, 2),
+        "audio_seconds": round(audio_seconds*(sessions-len(errors)), 2),
+        "utterances": utterances,
+        "utterances_per_second": round(utterances/wall_seconds, 2),
+        "connect_ms": percentiles(connects),
+        "vad_start_ms": percentiles(vad_starts),
+        "final_ms": percentiles(finals),
+        "error_rate": round(len(errors)/sessions, 4),
+        "errors": errors[: 10]
+    }
+
+
+def main(url, wav_dir, sessions = 10, ramp = 10, loops = 1, speakers = None, threshold = None,
+         extra = None, drain_time = 5, seed = None, output = None):
+    if seed is not None:
+        random.seed(seed)
+    audios = load_audios(wav_dir)
+    choices = dict(PARAM_CHOICES)
+    if speakers:
+        choices["speaker_verify"] = [None]+(speakers.split(",") if isinstance(speakers, str) else list(speakers))
+    fixed = {}
+    if threshold is not None:
+        fixed["threshold"] = threshold
+    if extra:
+        # 例如 --extra "protocol=1&encoding=json"
+        for item in extra.split("&"):
+            key, value = item.split("=", 1)
+            fixed[key] = value
+    result = asyncio.run(load(url, audios, sessions, ramp, loops, choices, fixed, drain_time))
+    print(json.dumps(result, ensure_ascii = False, indent = 2))
+    if output:
+        with open(output, "w", encoding = "utf-8") as f:
+            json.dump(result, f, ensure_ascii = False, indent = 2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,230 @@
+import json
+import time
+import asyncio
+import threading
+import traceback
+
+import fire
+import pyaudio
+import websockets
+
+from client import logger, STTClient, LLMClient, TTSClient, FORMAT, CHANNELS, CHUNK, CHUNK_BYTES, INPUT_RATE, OUTPUT_RATE
+
+
+# 单进程版本：录音与播放各占一个线程做阻塞 I/O，STT/LLM/TTS 为同一事件循环中的协程
+# 各环节之间通过 asyncio 队列交接，没有轮询
+
+AUDIO_IN_QUEUE_SIZE = 64     # 待发送的录音包数，约 4 s，满载时丢弃新录到的音频
+AUDIO_OUT_QUEUE_SIZE = 32    # 待播放的音频块数，约 0.7 s，满载时 TTS 等待播放
+
+DONE = object()
+
+
+class AudioThreads:
+
+    def __init__(self, loop, audio_in, audio_out):
+        self.loop = loop
+        self.audio_in = audio_in
+        self.audio_out = audio_out
+        self.stopped = threading.Event()
+        self.dropped = 0
+        self.threads = [threading.Thread(target = self.record, name = "recorder", daemon = True),
+                        threading.Thread(target = self.play, name = "player", daemon = True)]
+
+    def start(self, ):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, ):
+        self.stopped.set()
+
+    def put(self, data):
+        # 在事件循环中执行
+        if self.audio_in.full():
+            self.dropped += 1
+            logger.warning(f"[Recorder] Overrun, dropped {self.dropped} packets")
+            return
+        self.audio_in.put_nowait(data)
+
+    def record(self, ):
+        audio = pyaudio.PyAudio()
+        stream = audio.open(format = FORMAT, channels = CHANNELS, rate = INPUT_RATE, frames_per_buffer = CHUNK, input = True)
+        try:
+            while not self.stopped.is_set():
+                data = stream.read(CHUNK)
+                self.loop.call_soon_threadsafe(self.put, data)
+        except Exception as e:
+            print(f"[Recorder] Error: {e}")
+            traceback.print_exc()
+        finally:
+            stream.stop_stream()
+            stream.close()
+            audio.terminate()
+
+    def play(self, ):
+        audio = pyaudio.PyAudio()
+        stream = audio.open(format = FORMAT, channels = CHANNELS, rate = OUTPUT_RATE, frames_per_buffer = CHUNK, output = True)
+        try:
+            while not self.stopped.is_set():
+                # 线程阻塞在事件循环的队列上，有数据时才被唤醒
+                data = asyncio.run_coroutine_threadsafe(self.audio_out.get(), self.loop).result()
+                if data is DONE:
+                    break
+                stream.write(data)
+        except Exception as e:
+            print(f"[Player] Error: {e}")
+            traceback.print_exc()
+        finally:
+            stream.stop_stream()
+            stream.close()
+            audio.terminate()
+
+
+class Orchestrator:
+
+    def __init__(self, config):
+        self.stt = STTClient(config["stt"])
+        self.llm = LLMClient(config["llm"])
+        self.tts = TTSClient(config["tts"])
+        self.audio_in = asyncio.Queue(maxsize = AUDIO_IN_QUEUE_SIZE)
+        self.audio_out = asyncio.Queue(maxsize = AUDIO_OUT_QUEUE_SIZE)
+        self.user_texts = asyncio.Queue()
+        self.turn = None        # 当前回复的任务：LLM 生成 + TTS 合成与播放
+        self.spoken = []        # 当前回复中已经播放完的句子
+
+    async def send_audio(self, websocket):
+        while True:
+            data = await self.audio_in.get()
+            for packet in self.stt.encoder.encode(data):
+                await websocket.send(packet)
+
+    async def receive_text(self, websocket):
+        async for data in websocket:
+            logger.info(f"[STT] {data}")
+            msg = self.stt.parse(data)
+            if msg["type"] == "vad_start":
+                if self.stt.stop_at_vad_start:
+                    await self.user_texts.put((time.perf_counter(), "")) # 只打断当前回复
+            elif msg["type"] == "final":
+                if msg.get("revision", 0) > 0: # 纠错后的后续消息不送入 LLM
+                    continue
+                if msg["text"]:
+                    await self.user_texts.put((time.perf_counter(), msg["text"]))
+
+    async def run_stt(self, ):
+        async with websockets.connect(self.stt.params_url) as websocket:
+            tasks = [asyncio.create_task(self.send_audio(websocket)), asyncio.create_task(self.receive_text(websocket))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    async def synthesize(self, sentences, responses):
+        # 句子到达即发起 TTS 请求，与播放并行
+        sents = []
+        while True:
+            sent = await sentences.get()
+            if sent is DONE:
+                break
+            sents.append(sent)
+            grouped_sents, cleaned_sents, sents = self.tts.group_sents(sents)
+            for grouped_sent, cleaned_sent in zip(grouped_sents, cleaned_sents):
+                await responses.put((grouped_sent, asyncio.create_task(self.tts.request(cleaned_sent))))
+        await responses.put(DONE)
+
+    async def speak(self, responses):
+        while True:
+            item = await responses.get()
+            if item is DONE:
+                break
+            grouped_sent, request = item
+            response = await request
+            try:
+                logger.info(f"[TTS] Start: {grouped_sent}")
+                async for chunk in response.aiter_bytes(chunk_size = CHUNK_BYTES):
+                    await self.audio_out.put(chunk)
+                logger.info(f"[TTS] Finished: {grouped_sent}")
+                self.spoken.append(grouped_sent)
+            finally:
+                await response.aclose()
+
+    async def reply(self, messages):
+        sentences = asyncio.Queue()
+        responses = asyncio.Queue()
+        tasks = [asyncio.create_task(self.synthesize(sentences, responses)), asyncio.create_task(self.speak(responses))]
+        try:
+            segmenter = self.llm.segmenter()
+            async for delta in self.llm.stream(messages):
+                for sent in segmenter.push(delta):
+                    logger.info(f"[LLM] Sent: {sent}")
+                    await sentences.put(sent)
+            prefix = segmenter.flush()
+            if prefix:
+                logger.info(f"[LLM] Prefix: {prefix}")
+                await sentences.put(prefix)
+            await sentences.put(DONE)
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            print(f"[Reply] Error: {e}")
+            traceback.print_exc()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            # 已发起但未播放的 TTS 请求一并取消
+            while not responses.empty():
+                item = responses.get_nowait()
+                if item is not DONE:
+                    item[1].cancel()
+
+    async def interrupt(self, interrupt_time):
+        await self.llm.cancel(self.turn, interrupt_time)
+        self.turn = None
+        # 已缓冲但未播放的音频不再播放
+        while not self.audio_out.empty():
+            self.audio_out.get_nowait()
+
+    async def converse(self, ):
+        while True:
+            interrupt_time, user = await self.user_texts.get()
+            await self.interrupt(interrupt_time)
+            while not self.user_texts.empty():
+                user += self.user_texts.get_nowait()[1]
+            if not user:
+                continue
+            assistant = "".join(self.spoken)
+            self.spoken = []
+            if assistant:
+                self.llm.context.append("assistant", assistant)
+            self.llm.context.append("user", user)
+            logger.info(f"[LLM] User: {user}")
+            self.turn = asyncio.create_task(self.reply(self.llm.context.messages()))
+
+    async def run(self, ):
+        threads = AudioThreads(asyncio.get_running_loop(), self.audio_in, self.audio_out)
+        threads.start()
+        try:
+            await asyncio.gather(self.run_stt(), self.converse())
+        finally:
+            threads.stop()
+            await self.interrupt(time.perf_counter())
+            self.audio_out.put_nowait(DONE)
+            await self.llm.http_client.aclose()
+
+
+def main(config_path):
+    logger.info("*"*20 + "  Config  " + "*"*20)
+    with open(config_path, "r", encoding = "utf-8") as f:
+        config = json.load(f)
+    logger.info(json.dumps(config, ensure_ascii = False, indent = 2))
+    logger.info("*"*50)
+    try:
+        asyncio.run(Orchestrator(config).run())
+    except Exception as e:
+        print(f"[Orchestrator] Error: {e}")
+        traceback.print_exc()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
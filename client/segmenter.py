@@ -0,0 +1,77 @@
+STOPS = "．！？｡。?!~—…\n\r"     # 句末
+CLAUSES = "，；,;"                # 分句
+
+
+class SentenceSegmenter:
+
+    # 流式切分 LLM 输出，交给 TTS 合成，每个字符只扫描一次
+    # - 第一段尽早送出：到 min_first 字后遇到分句标点即切，仍没有标点时到 max_first 字强制切（英文等在空格处切）
+    # - 之后的段更长，韵律更自然：不足 min_chars 字的短句与下一句合并，超过 max_chars 字时在分句标点处切
+    def __init__(self, min_first = 4, max_first = 16, min_chars = 10, max_chars = 60, stops = STOPS, clauses = CLAUSES):
+        self.min_first = min_first
+        self.max_first = max_first
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.stops = set(stops)
+        self.clauses = set(clauses)
+        self.reset()
+
+    def reset(self, ):
+        # 每次回复开始时调用
+        self.buffer = []
+        self.length = 0          # buffer 中非空白字符数
+        self.words = 0           # buffer 中的文字（字母、数字、汉字）数，没有文字的段不送出
+        self.count = 0           # 已送出的段数
+        self.dots = 0            # 连续的 "."，"..." 视为句末
+
+    def cut(self, char):
+        if self.words == 0:
+            return False
+        if self.count == 0:
+            if char in self.stops:
+                return True
+            if char in self.clauses:
+                return self.length >= self.min_first
+            return self.length >= self.max_first and (char.isspace() or not char.isascii())
+        if char in self.stops:
+            return self.length >= self.min_chars
+        if char in self.clauses:
+            return self.length >= self.max_chars
+        return False
+
+    def emit(self, ):
+        sent = "".join(self.buffer)
+        words = self.words
+        self.buffer = []
+        self.length = 0
+        self.words = 0
+        if words == 0:
+            return None
+        self.count += 1
+        return sent
+
+    def push(self, delta):
+        # 返回本次可以送出的段（可能为空）
+        sents = []
+        if not delta:
+            return sents
+        for char in delta:
+            if self.words == 0 and (char in self.stops or char in self.clauses or char == "."):
+                # 段首的标点是上一段句末标点的延续（如 "。。"、"...."），丢弃，不单独成段
+                self.dots = 0
+                continue
+            self.buffer.append(char)
+            if not char.isspace():
+                self.length += 1
+            if char.isalnum():
+                self.words += 1
+            self.dots = self.dots+1 if char == "." else 0
+            if self.cut("…" if self.dots >= 3 else char):
+                sent = self.emit()
+                if sent:
+                    sents.append(sent)
+        return sents
+
+    def flush(self, ):
+        # 生成结束时送出剩余部分
+        return self.emit()
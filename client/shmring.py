@@ -0,0 +1,164 @@
+import time
+import numpy as np
+from multiprocessing import Lock, Semaphore, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+# 头部字段，只在持有锁时读写
+WRITE = 0       # 已写入的总字节数
+READ = 1        # 已读取（或作废）的总字节数
+OVERRUNS = 2    # 空间不足被丢弃的写入次数
+DROPPED = 3     # 空间不足被丢弃的字节数
+UNDERRUNS = 4   # 阻塞读取时数据不足、需要等待的次数
+
+HEADER_SIZE = 8*8
+
+
+def drain(semaphore):
+    # 只保留一次唤醒，避免计数无限增长
+    while semaphore.acquire(False):
+        pass
+
+
+def attach(name):
+    # 子进程只挂载不负责回收，避免 resource_tracker 在子进程退出时删除共享内存
+    try:
+        return SharedMemory(name = name, track = False)
+    except TypeError:
+        shm = SharedMemory(name = name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class AudioRing:
+
+    # 单生产者/单消费者的共享内存音频环形缓冲区，跨进程传递音频不需要序列化
+    # numpy 的读写没有内存屏障，在 ARM 等弱内存序的 CPU 上对方可能先看到新的位置、后看到数据，
+    # 因此数据拷贝与位置更新都在跨进程锁内完成，锁的获取与释放保证了可见顺序；每次只拷贝一小段音频，竞争可以忽略
+    # 信号量只用于唤醒阻塞的一方，等待时不持有锁
+
+    def __init__(self, capacity, align = 2):
+        self.capacity = capacity - capacity % align
+        self.align = align                  # 读写长度按采样点对齐，int16 为 2 字节
+        self.shm = SharedMemory(create = True, size = HEADER_SIZE+self.capacity)
+        self.owner = True
+        self.lock = Lock()
+        self.readable = Semaphore(0)        # 生产者写入后通知
+        self.writable = Semaphore(0)        # 消费者读取后通知
+        self.attach_views()
+        self.header[:] = 0
+
+    def attach_views(self, ):
+        self.header = np.ndarray((HEADER_SIZE//8, ), dtype = np.int64, buffer = self.shm.buf)
+        self.data = np.ndarray((self.capacity, ), dtype = np.uint8, buffer = self.shm.buf, offset = HEADER_SIZE)
+
+    def __getstate__(self, ):
+        return {"name": self.shm.name, "capacity": self.capacity, "align": self.align,
+                "lock": self.lock, "readable": self.readable, "writable": self.writable}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.align = state["align"]
+        self.lock = state["lock"]
+        self.readable = state["readable"]
+        self.writable = state["writable"]
+        self.shm = attach(state["name"])
+        self.owner = False
+        self.attach_views()
+
+    def available(self, ):
+        # 调用方需持有锁
+        return int(self.header[WRITE])-int(self.header[READ])
+
+    def free(self, ):
+        # 调用方需持有锁
+        return self.capacity-self.available()
+
+    def write(self, data, block = False, timeout = None):
+        # 空间不足时：block=False 丢弃本次写入并计数，block=True 等待消费者读取
+        size = len(data)
+        if size > self.capacity:
+            raise ValueError(f"Write of {size} bytes exceeds ring capacity {self.capacity}")
+        deadline = None if timeout is None else time.monotonic()+timeout
+        while True:
+            remaining = None if deadline is None else deadline-time.monotonic()
+            with self.lock:
+                if self.free() >= size:
+                    write = int(self.header[WRITE])
+                    pos = write % self.capacity
+                    first = min(size, self.capacity-pos)
+                    samples = np.frombuffer(data, dtype = np.uint8)
+                    self.data[pos: pos+first] = samples[: first]
+                    self.data[: size-first] = samples[first: ]
+                    self.header[WRITE] = write+size
+                    break
+                if not block or (remaining is not None and remaining <= 0):
+                    self.header[OVERRUNS] += 1
+                    self.header[DROPPED] += size
+                    return False
+            self.writable.acquire(timeout = remaining)
+        drain(self.writable)
+        self.readable.release()
+        return True
+
+    def discard(self, ):
+        # 生产者调用：尚未读取的数据全部作废（例如打断后不再播放）
+        with self.lock:
+            self.header[READ] = self.header[WRITE]
+        self.writable.release()
+        self.readable.release()
+
+    def take(self, size):
+        # 调用方需持有锁
+        read = int(self.header[READ])
+        size = min(size, int(self.header[WRITE])-read)
+        size -= size % self.align
+        pos = read % self.capacity
+        first = min(size, self.capacity-pos)
+        data = self.data[pos: pos+first].tobytes()+self.data[: size-first].tobytes()
+        self.header[READ] = read+size
+        return data
+
+    def read_nowait(self, size):
+        # 返回不超过 size 字节的已有数据，没有数据时返回 b""
+        with self.lock:
+            data = self.take(size)
+        self.writable.release()
+        return data
+
+    def read(self, size, min_size = None, timeout = None):
+        # 阻塞直到至少有 min_size（默认 size）字节，返回不超过 size 字节；超时返回 None
+        min_size = size if min_size is None else min_size
+        deadline = None if timeout is None else time.monotonic()+timeout
+        waited = False
+        while True:
+            with self.lock:
+                if self.available() >= min_size:
+                    data = self.take(size)
+                    break
+                if not waited:
+                    self.header[UNDERRUNS] += 1
+                    waited = True
+            remaining = None if deadline is None else deadline-time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.readable.acquire(timeout = remaining)
+        drain(self.readable)
+        self.writable.release()
+        return data
+
+    def stats(self, ):
+        with self.lock:
+            return {
+                "capacity": self.capacity,
+                "buffered": self.available(),
+                "overruns": int(self.header[OVERRUNS]),
+                "dropped_bytes": int(self.header[DROPPED]),
+                "underruns": int(self.header[UNDERRUNS])
+            }
+
+    def close(self, ):
+        self.header = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+
+# 客户端模块以脚本方式运行，相互之间直接 import（如 from shmring import AudioRing），测试时将本目录加入搜索路径
+CLIENT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if CLIENT_PATH not in sys.path:
+    sys.path.insert(0, CLIENT_PATH)
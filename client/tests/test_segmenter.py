@@ -0,0 +1,24 @@
+from segmenter import SentenceSegmenter
+
+
+def segment(deltas):
+    segmenter = SentenceSegmenter()
+    sents = []
+    for delta in deltas:
+        sents.extend(segmenter.push(delta))
+    sent = segmenter.flush()
+    if sent:
+        sents.append(sent)
+    return sents
+
+
+def test_repeated_stops_do_not_form_a_segment():
+    assert segment(["好的。。", "我们现在开始今天的会议吧。。。"]) == ["好的。", "我们现在开始今天的会议吧。"]
+
+
+def test_leading_dots_do_not_form_a_segment():
+    assert segment(["....", "嗯...."]) == ["嗯..."]
+
+
+def test_trailing_stops_are_dropped_at_flush():
+    assert segment(["你好，很高兴认识你。", "！"]) == ["你好，很高兴认识你。"]
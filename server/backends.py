@@ -0,0 +1,188 @@
+import os
+import copy
+import threading
+
+import torch
+import numpy as np
+from funasr import AutoModel
+
+try:
+    import onnxruntime
+    import funasr_onnx
+    import kaldi_native_fbank as knf
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from funasr_onnx.utils.utils import read_yaml
+    from funasr_onnx.utils.frontend import WavFrontendOnline
+    from funasr_onnx.utils.e2e_vad import E2EVadModel
+except ImportError:
+    onnxruntime = None
+
+
+# 模型推理后端
+# torch: funasr AutoModel (fp32)
+# onnx: onnxruntime + int8 动态量化，首次加载时自动导出到模型目录
+# onnx_fp32: onnxruntime 不量化，用于对比量化带来的精度损失
+TORCH = "torch"
+ONNX = "onnx"
+ONNX_FP32 = "onnx_fp32"
+
+BACKENDS = [TORCH, ONNX, ONNX_FP32]
+
+
+# 以下各类的 generate 与 AutoModel.generate 的返回格式保持一致，VADModel/ASRModel 无需区分后端
+
+
+def session_options(threads):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    return options
+
+
+def flatten_segments(value):
+    # funasr_onnx 的 VAD 结果按批次嵌套，展开为 [[start_ms, end_ms], ...]
+    if len(value) == 2 and all(isinstance(v, (int, np.integer)) for v in value):
+        return [[int(value[0]), int(value[1])]]
+    return [pair for v in value for pair in flatten_segments(v)]
+
+
+class OnnxVAD:
+
+    def __init__(self, model_path, max_end_silence_time = 200, speech_noise_thres = 0.8, quantize = True, threads = 1):
+        self.model_path = model_path
+        self.quantize = quantize
+        self.threads = threads
+        self.config = read_yaml(os.path.join(model_path, "config.yaml"))
+        self.config["model_conf"].update(max_end_silence_time = max_end_silence_time,
+                                         speech_noise_thres = speech_noise_thres)
+        self.online = funasr_onnx.Fsmn_vad_online(model_path, quantize = quantize, intra_op_num_threads = threads,
+                                                  max_end_sil = max_end_silence_time)
+        self.offline = None
+        self.lock = threading.Lock()
+
+    def stream(self, ):
+        # 各会话共享 onnx 会话，特征提取与端点状态按会话独立
+        stream = copy.copy(self.online)
+        stream.frontend = WavFrontendOnline(cmvn_file = os.path.join(self.model_path, "am.mvn"),
+                                            **self.config["frontend_conf"])
+        stream.vad_scorer = E2EVadModel(self.config["model_conf"])
+        return stream
+
+    def segment(self, audio):
+        with self.lock:
+            if self.offline is None:
+                self.offline = funasr_onnx.Fsmn_vad(self.model_path, quantize = self.quantize,
+                                                    intra_op_num_threads = self.threads,
+                                                    max_end_sil = self.config["model_conf"]["max_end_silence_time"])
+        return flatten_segments(self.offline(audio_in = audio))
+
+    def generate(self, input, chunk_size = None, cache = None, is_final = True):
+        samples = np.asarray(input, dtype = np.float32)
+        if cache is None:
+            return [{"value": self.segment(samples)}]
+        if "stream" not in cache:
+            cache["stream"] = self.stream()
+            cache["param_dict"] = {"in_cache": []}
+        cache["param_dict"]["is_final"] = is_final
+        return [{"value": flatten_segments(cache["stream"](audio_in = samples, param_dict = cache["param_dict"]))}]
+
+
+def export_campplus(model_path, onnx_path, quant_path = None):
+    # funasr_onnx 没有 CAM++，直接导出 funasr 中的网络：输入 fbank 特征 (B, T, 80)，输出说话人向量 (B, D)
+    model = AutoModel(model = model_path, disable_pbar = True).model.eval()
+    feats = torch.randn(1, 300, 80)
+    with torch.no_grad():
+        torch.onnx.export(model, feats, onnx_path, input_names = ["feats"], output_names = ["embedding"],
+                          dynamic_axes = {"feats": {0: "batch", 1: "frames"}, "embedding": {0: "batch"}},
+                          opset_version = 14)
+    if quant_path is not None:
+        quantize_dynamic(onnx_path, quant_path, weight_type = QuantType.QUInt8)
+
+
+class OnnxSpeaker:
+
+    def __init__(self, model_path, quantize = True, threads = 1, sample_rate = 16000):
+        onnx_path = os.path.join(model_path, "campplus.onnx")
+        quant_path = os.path.join(model_path, "campplus_quant.onnx")
+        path = quant_path if quantize else onnx_path
+        if not os.path.exists(path):
+            export_campplus(model_path, onnx_path, quant_path if quantize else None)
+        self.session = onnxruntime.InferenceSession(path, session_options(threads),
+                                                    providers = ["CPUExecutionProvider"])
+        self.sample_rate = sample_rate
+        # 与 funasr CAM++ 的特征一致：80 维 kaldi fbank，无抖动，按句减均值
+        self.opts = knf.FbankOptions()
+        self.opts.frame_opts.dither = 0
+        self.opts.frame_opts.samp_freq = sample_rate
+        self.opts.mel_opts.num_bins = 80
+
+    def features(self, samples):
+        fbank = knf.OnlineFbank(self.opts)
+        fbank.accept_waveform(self.sample_rate, samples.tolist())
+        fbank.input_finished()
+        feats = np.stack([fbank.get_frame(i) for i in range(fbank.num_frames_ready)]).astype(np.float32)
+        return feats-feats.mean(axis = 0, keepdims = True)
+
+    def generate(self, data):
+        feats = self.features(np.asarray(data, dtype = np.float32))
+        embedding = self.session.run(None, {"feats": feats[None]})[0]
+        return [{"spk_embedding": torch.from_numpy(embedding)}]
+
+
+def load_arrays(load_data):
+    # funasr_onnx 的 load_data 把列表中的元素当作文件路径读取，这里让数组列表直接作为一批输入
+    def wrapper(wav_content, fs = None):
+        if isinstance(wav_content, list) and all(isinstance(wav, np.ndarray) for wav in wav_content):
+            return wav_content
+        return load_data(wav_content, fs)
+    return wrapper
+
+
+class OnnxASR:
+
+    def __init__(self, model_path, quantize = True, threads = 1, batch_size = 16):
+        self.model = funasr_onnx.SenseVoiceSmall(model_path, batch_size = batch_size, quantize = quantize,
+                                                 intra_op_num_threads = threads)
+        self.model.load_data = load_arrays(self.model.load_data)
+
+    def generate(self, speeches, use_itn = True, batch_size = 1, **kwargs):
+        speeches = [np.asarray(speech, dtype = np.float32) for speech in speeches]
+        # funasr_onnx 通过 textnorm 选择是否 ITN，未知参数会被忽略，use_itn 一并传入以兼容其它版本
+        texts = self.model(speeches, language = "auto", textnorm = "withitn" if use_itn else "woitn", use_itn = use_itn)
+        return [{"text": text} for text in texts]
+
+
+class OnnxPunctuation:
+
+    def __init__(self, model_path, quantize = True, threads = 1):
+        self.model = funasr_onnx.CT_Transformer(model_path, quantize = quantize, intra_op_num_threads = threads)
+
+    def generate(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+        return [{"text": self.model(text)[0]} for text in texts]
+
+
+ONNX_MODELS = {
+    "vad": OnnxVAD,
+    "spk": OnnxSpeaker,
+    "asr": OnnxASR,
+    "pun": OnnxPunctuation
+}
+
+
+def load_model(kind, model_path, backend = TORCH, **kwargs):
+    # kind: vad / spk / asr / pun，kwargs 为两种后端共用的模型参数
+    if backend == TORCH:
+        return AutoModel(model = model_path, disable_pbar = True, **kwargs)
+    if backend in [ONNX, ONNX_FP32]:
+        if onnxruntime is None:
+            raise ValueError("onnx backend requires onnxruntime, funasr_onnx and kaldi_native_fbank")
+        # 线程数沿用当前进程的 torch 设置（多 worker 时已按核数分配）
+        return ONNX_MODELS[kind](model_path, quantize = backend == ONNX, threads = torch.get_num_threads(), **kwargs)
+    raise ValueError(f"Unsupported backend: {backend}")
+
+
+def fork_safe(backend):
+    # onnxruntime 会话的线程池在 fork 后不可用，只能在子进程中加载
+    return backend == TORCH
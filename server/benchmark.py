@@ -0,0 +1,199 @@
+import logging
+logging.basicConfig(level = logging.WARNING, format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+import os
+import json
+import time
+import asyncio
+import resource
+
+import fire
+import soundfile
+import numpy as np
+
+from src.executor import InferenceExecutor
+from src.scheduler import ASRScheduler, VADScheduler
+from src.codec import resample, to_pcm
+from src.protocol import VAD_END, FINAL
+from src.pipeline import VAD, ASR, INPUT_BYTE_SIZE, INPUT_SAMPLE_RATE, INPUT_CHANNELS
+
+
+SILENCE_TIME = 1.            # 每个文件之后补充的静音长度 (s)，保证 VAD 能检测到语音结束
+
+
+def load_corpus(wav_dir):
+    corpus = []
+    for file in sorted(os.listdir(wav_dir)):
+        if os.path.splitext(file)[1].lower() not in [".wav", ".flac"]:
+            continue
+        samples, sample_rate = soundfile.read(os.path.join(wav_dir, file), dtype = "float32", always_2d = True)
+        samples = samples.mean(axis = 1)*32768
+        samples = resample(samples, sample_rate, INPUT_SAMPLE_RATE)
+        silence = np.zeros(int(SILENCE_TIME*INPUT_SAMPLE_RATE), dtype = np.float32)
+        corpus.append(to_pcm(np.concatenate([samples, silence])))
+    if len(corpus) == 0:
+        raise Exception(f"No audio found in {wav_dir}!")
+    return corpus
+
+
+def build_models(stub, model_root, speakers_path, executors, backend = "torch"):
+    from src.models import VADModel, ASRModel
+    vad_model = VADModel(os.path.join(model_root, "speech_fsmn_vad_zh-cn-16k-common-pytorch"),
+                         executor = executors["vad"], backend = backend)
+    asr_model = ASRModel(os.path.join(model_root, "speech_campplus_sv_zh_en_16k-common_advanced"),
+                         os.path.join(model_root, "SenseVoiceSmall"),
+                         os.path.join(model_root, "punc_ct-transformer_zh-cn-common-vocab272727-pytorch"),
+                         speakers_path, executor = executors["asr"], logger = logger,
+                         backends = {"spk": backend, "asr": backend, "pun": backend})
+    if stub:
+        from src.stubs import StubVAD, StubSpeaker, StubASR, StubPunctuation, StubCorrector
+        vad_model.loader.value = StubVAD()
+        asr_model.loaders["spk"].value = StubSpeaker()
+        asr_model.loaders["asr"].value = StubASR()
+        asr_model.loaders["pun"].value = StubPunctuation()
+        asr_model.loaders["corrector"].value = StubCorrector()
+    return vad_model, asr_model
+
+
+class Session:
+
+    def __init__(self, index, audios, vad_scheduler, asr_scheduler, speed, options):
+        self.index = index
+        self.audios = audios
+        self.speed = speed
+        self.inp_queue = asyncio.Queue()
+        self.asr_queue = asyncio.Queue()
+        self.outp_queue = asyncio.Queue()
+        self.vad = VAD(vad_scheduler, self.inp_queue, self.asr_queue, self.outp_queue)
+        self.asr = ASR(asr_scheduler, self.asr_queue, self.outp_queue, **options)
+        self.audio_seconds = sum(len(audio) for audio in audios)/2/INPUT_CHANNELS/INPUT_SAMPLE_RATE
+        self.latencies = []
+        self.finals = 0
+        self.ends = 0
+
+    async def feed(self, ):
+        # 按 Recorder 的分包大小送入音频，speed <= 0 时不限速
+        packet_time = INPUT_BYTE_SIZE/2/INPUT_CHANNELS/INPUT_SAMPLE_RATE
+        start_time = time.monotonic()
+        sent = 0
+        for audio in self.audios:
+            for k in range(0, len(audio), INPUT_BYTE_SIZE):
+                await self.inp_queue.put(audio[k: k+INPUT_BYTE_SIZE])
+                sent += 1
+                if self.speed > 0:
+                    delay = start_time+sent*packet_time/self.speed-time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    await asyncio.sleep(0)
+
+    async def collect(self, ):
+        end_times = {}
+        while True:
+            msg = await self.outp_queue.get()
+            if msg["type"] == VAD_END:
+                self.ends += 1
+                end_times[msg["utt"]] = time.monotonic()
+            elif msg["type"] == FINAL and msg["result"].get("revision", 0) == 0:
+                self.finals += 1
+                if msg["utt"] in end_times:
+                    self.latencies.append(time.monotonic()-end_times.pop(msg["utt"]))
+
+    async def run(self, drain_timeout):
+        tasks = [asyncio.create_task(task) for task in [self.vad.run(), self.asr.run(), self.collect()]]
+        try:
+            await self.feed()
+            deadline = time.monotonic()+drain_timeout
+            while (self.finals < self.ends or not self.inp_queue.empty() or not self.asr_queue.empty()) \
+                    and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    return round(float(np.percentile(values, q))*1000, 1)
+
+
+async def benchmark(corpus, sessions, speed, stub, model_root, speakers_path, options, config):
+    executors = {
+        "vad": InferenceExecutor(max_workers = config["vad_workers"], name = "vad"),
+        "asr": InferenceExecutor(max_workers = config["asr_workers"], name = "asr")
+    }
+    vad_model, asr_model = build_models(stub, model_root, speakers_path, executors, config["backend"])
+    vad_scheduler = VADScheduler(vad_model, max_batch_size = config["vad_batch_size"], max_wait_time = config["vad_wait_time"], 
+                                 concurrency = config["vad_workers"])
+    asr_scheduler = ASRScheduler(asr_model, max_batch_size = config["asr_batch_size"], max_wait_time = config["asr_wait_time"], 
+                                 concurrency = config["asr_workers"])
+    background_tasks = [asyncio.create_task(task) for task in
+                        [vad_scheduler.run(), asr_scheduler.run(), asr_model.postprocessor.run()]]
+    # 每个会话从不同的文件开始轮流播放整个语料
+    runners = [Session(k, corpus[k % len(corpus): ]+corpus[: k % len(corpus)],
+                       vad_scheduler, asr_scheduler, speed, options) for k in range(sessions)]
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.monotonic()
+    await asyncio.gather(*[runner.run(config["drain_timeout"]) for runner in runners])
+    wall_seconds = time.monotonic()-start_time
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    for task in background_tasks:
+        task.cancel()
+    for executor in executors.values():
+        executor.shutdown()
+    cpu_seconds = (usage_after.ru_utime-usage_before.ru_utime)+(usage_after.ru_stime-usage_before.ru_stime)
+    audio_seconds = sum(runner.audio_seconds for runner in runners)
+    latencies = [latency for runner in runners for latency in runner.latencies]
+    finals = sum(runner.finals for runner in runners)
+    return {
+        "sessions": sessions,
+        "speed": speed,
+        "stub": stub,
+        "options": options,
+        "config": config,
+        "audio_seconds": round(audio_seconds, 2),
+        "wall_seconds": round(wall_seconds, 2),
+        "rtf": round(wall_seconds/audio_seconds, 4),
+        "utterances": finals,
+        "unfinished": sum(runner.ends-runner.finals for runner in runners),
+        "utterances_per_second": round(finals/wall_seconds, 2),
+        "latency_ms": {"p50": percentile(latencies, 50), "p90": percentile(latencies, 90),
+                       "p99": percentile(latencies, 99), "max": percentile(latencies, 100)},
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_utilization": round(cpu_seconds/wall_seconds, 2),
+        "peak_rss_mb": round(usage_after.ru_maxrss/1024, 1),
+        "executors": {name: executor.report() for name, executor in executors.items()}
+    }
+
+
+def main(wav_dir, sessions = 1, speed = 1.0, stub = False, output = None,
+         model_root = "Path_to_Model's_Dir", speakers_path = "./speakers",
+         speaker_verify = None, threshold = 0.5, language_check = True,
+         use_itn = True, add_punctuations = True, use_corrector = False, speculative = False,
+         vad_workers = 2, asr_workers = 2, vad_batch_size = 64, vad_wait_time = 10,
+         asr_batch_size = 8, asr_wait_time = 50, drain_timeout = 30, backend = "torch"):
+    corpus = load_corpus(wav_dir)
+    options = {
+        "speaker_verify": speaker_verify, "threshold": threshold, "language_check": language_check,
+        "use_itn": use_itn, "add_punctuations": add_punctuations, "use_corrector": use_corrector,
+        "speculative": speculative
+    }
+    config = {
+        "vad_workers": vad_workers, "asr_workers": asr_workers,
+        "vad_batch_size": vad_batch_size, "vad_wait_time": vad_wait_time,
+        "asr_batch_size": asr_batch_size, "asr_wait_time": asr_wait_time,
+        "drain_timeout": drain_timeout, "backend": backend
+    }
+    result = asyncio.run(benchmark(corpus, sessions, speed, stub, model_root, speakers_path, options, config))
+    result["wav_dir"] = wav_dir
+    print(json.dumps(result, ensure_ascii = False, indent = 2))
+    if output:
+        with open(output, "w", encoding = "utf-8") as f:
+            json.dump(result, f, ensure_ascii = False, indent = 2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
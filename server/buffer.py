@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class AudioBuffer:
+
+    def __init__(self, capacity, initial = None):
+        # capacity: 容量上限；initial: 初始分配的大小，写入时按需倍增到 capacity，数据被清出后再缩回
+        self.capacity = capacity
+        self.initial = capacity if initial is None else min(initial, capacity)
+        self.data = np.zeros(self.initial, dtype = np.float32)
+        self.base = 0       # data[0] 对应的绝对采样点位置
+        self.head = 0       # 有效数据在 data 中的起点
+        self.tail = 0       # 有效数据在 data 中的终点
+        self.dropped = 0    # 因容量不足被丢弃的采样点数
+
+    def __len__(self, ):
+        return self.tail-self.head
+
+    @property
+    def start(self, ):
+        return self.base+self.head
+
+    @property
+    def end(self, ):
+        return self.base+self.tail
+
+    def compact(self, ):
+        if self.head > 0:
+            size = len(self)
+            self.data[: size] = self.data[self.head: self.tail]
+            self.base += self.head
+            self.head = 0
+            self.tail = size
+
+    def resize(self, size):
+        data = np.zeros(size, dtype = np.float32)
+        data[: len(self)] = self.data[self.head: self.tail]
+        self.data = data
+        self.base += self.head
+        self.tail = len(self)
+        self.head = 0
+
+    def write(self, pcm):
+        samples = np.frombuffer(pcm, dtype = np.int16)
+        size = len(samples)
+        if self.tail+size > len(self.data):
+            # 空间不足时先扩容（直到上限），再整理，仍不足则丢弃最旧的数据
+            needed = len(self)+size
+            if needed > len(self.data) and len(self.data) < self.capacity:
+                self.resize(min(max(needed, 2*len(self.data)), self.capacity))
+            overflow = needed-len(self.data)
+            if overflow > 0:
+                self.dropped += overflow
+                self.evict(self.start+overflow)
+            self.compact()
+        if size > len(self.data):
+            self.base += size-len(self.data)
+            samples = samples[-len(self.data): ]
+            size = len(self.data)
+        np.multiply(samples, 1./32768, out = self.data[self.tail: self.tail+size], casting = "unsafe")
+        self.tail += size
+
+    def view(self, start, end):
+        start = min(max(start, self.start), self.end)
+        end = min(max(end, start), self.end)
+        return self.data[start-self.base: end-self.base]
+
+    def evict(self, before):
+        self.head = min(max(before-self.base, self.head), self.tail)
+        if len(self.data) > self.initial and 4*len(self) <= len(self.data):
+            # 长语音结束后缩小，空闲会话只占用初始大小
+            self.resize(max(2*len(self), self.initial))
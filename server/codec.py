@@ -0,0 +1,154 @@
+import io
+import math
+import numpy as np
+import soundfile
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+
+TARGET_SAMPLE_RATE = 16000   # 送入 VAD/ASR 的采样率
+
+
+class StreamingResampler:
+
+    # 带限插值：Kaiser 窗 sinc 低通滤波器，降采样时截止于目标采样率的 Nyquist 频率，避免高频混叠到语音频段
+    # 第 k 个输出点位于输入的 k*up/down 处，小数相位只有 down 种，各相位的滤波器系数预先算好
+
+    def __init__(self, src_rate, dst_rate = TARGET_SAMPLE_RATE, zeros = 16, beta = 8.6, block_size = 4096):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        g = math.gcd(src_rate, dst_rate)
+        self.up = src_rate//g
+        self.down = dst_rate//g
+        cutoff = min(1., dst_rate/src_rate)
+        self.width = int(math.ceil(zeros/cutoff))     # 滤波器半宽（输入采样点）
+        self.block_size = block_size                  # 每次计算的输出点数，限制临时内存
+        taps = np.arange(-self.width+1, self.width+1)
+        distance = np.arange(self.down)[:, None]/self.down-taps[None, :]
+        window = np.i0(beta*np.sqrt(np.clip(1.-(distance/self.width)**2, 0., None)))/np.i0(beta)
+        self.filters = (cutoff*np.sinc(cutoff*distance)*window).astype(np.float32)
+        self.count = 0                                # 已输出的点数
+        self.base = -self.width+1                     # buffer[0] 对应的输入采样点位置，开头补零
+        self.buffer = np.zeros(self.width-1, dtype = np.float32)
+
+    def process(self, samples):
+        # 输出滞后 width 个输入采样点，流结束时调用 flush 取出剩余部分
+        if self.src_rate == self.dst_rate:
+            return samples
+        buffer = np.concatenate([self.buffer, samples.astype(np.float32)])
+        # 输出点 k 需要输入到 floor(k*up/down)+width 为止
+        last = self.base+len(buffer)-1-self.width
+        count = max(((last+1)*self.down-1)//self.up+1-self.count, 0)
+        outputs = []
+        offsets = np.arange(2*self.width)
+        for k in range(self.count, self.count+count, self.block_size):
+            ks = np.arange(k, min(k+self.block_size, self.count+count))
+            index = ks*self.up//self.down-self.width+1-self.base
+            phase = ks*self.up % self.down
+            outputs.append(np.einsum("ij,ij->i", buffer[index[:, None]+offsets], self.filters[phase]))
+        self.count += count
+        keep = self.count*self.up//self.down-self.width+1
+        self.buffer = buffer[keep-self.base: ]
+        self.base = keep
+        if len(outputs) == 0:
+            return np.zeros(0, dtype = np.float32)
+        return np.concatenate(outputs).astype(np.float32, copy = False)
+
+    def flush(self, ):
+        if self.src_rate == self.dst_rate:
+            return np.zeros(0, dtype = np.float32)
+        return self.process(np.zeros(self.width, dtype = np.float32))
+
+
+def resample(samples, src_rate, dst_rate = TARGET_SAMPLE_RATE):
+    # 整段音频重采样
+    if src_rate == dst_rate:
+        return samples
+    resampler = StreamingResampler(src_rate, dst_rate)
+    return np.concatenate([resampler.process(samples), resampler.flush()])
+
+
+def downmix(samples, channels):
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis = 1)
+    return samples
+
+
+def to_pcm(samples):
+    return np.clip(np.round(samples), -32768, 32767).astype(np.int16).tobytes()
+
+
+def read_audio(data):
+    # 完整音频文件 (wav/flac/ogg) 解码为 16k 单声道 float32，范围与 AudioBuffer 一致
+    samples, sample_rate = soundfile.read(io.BytesIO(data), dtype = "float32", always_2d = True)
+    samples = resample(samples.mean(axis = 1), sample_rate)
+    return samples.astype(np.float32, copy = False)
+
+
+class PCMDecoder:
+
+    def __init__(self, sample_rate = TARGET_SAMPLE_RATE, channels = 1):
+        self.channels = channels
+        self.resampler = StreamingResampler(sample_rate)
+
+    @property
+    def passthrough(self, ):
+        return self.channels == 1 and self.resampler.src_rate == TARGET_SAMPLE_RATE
+
+    def decode(self, data):
+        if self.passthrough:
+            return data
+        samples = downmix(np.frombuffer(data, dtype = np.int16).astype(np.float32), self.channels)
+        return to_pcm(self.resampler.process(samples))
+
+
+class OpusDecoder:
+
+    # 每个 websocket 消息为一个 Opus 包，解码器直接输出 16k 采样率
+    max_frame_size = TARGET_SAMPLE_RATE*120//1000
+    passthrough = False
+
+    def __init__(self, sample_rate = TARGET_SAMPLE_RATE, channels = 1):
+        if opuslib is None:
+            raise ValueError("opus codec requires opuslib")
+        self.channels = channels
+        self.decoder = opuslib.Decoder(TARGET_SAMPLE_RATE, channels)
+
+    def decode(self, data):
+        pcm = self.decoder.decode(data, self.max_frame_size)
+        if self.channels == 1:
+            return pcm
+        samples = downmix(np.frombuffer(pcm, dtype = np.int16).astype(np.float32), self.channels)
+        return to_pcm(samples)
+
+
+class FLACDecoder:
+
+    # 每个 websocket 消息为一段完整的 FLAC 流，采样率以流头部为准
+    passthrough = False
+
+    def __init__(self, sample_rate = TARGET_SAMPLE_RATE, channels = 1):
+        self.resampler = None
+
+    def decode(self, data):
+        samples, sample_rate = soundfile.read(io.BytesIO(data), dtype = "int16", always_2d = True)
+        samples = samples.astype(np.float32).mean(axis = 1)
+        if self.resampler is None or self.resampler.src_rate != sample_rate:
+            self.resampler = StreamingResampler(sample_rate)
+        return to_pcm(self.resampler.process(samples))
+
+
+DECODERS = {
+    "pcm": PCMDecoder,
+    "opus": OpusDecoder,
+    "flac": FLACDecoder
+}
+
+
+def make_decoder(codec = "pcm", sample_rate = TARGET_SAMPLE_RATE, channels = 1):
+    if codec not in DECODERS:
+        raise ValueError(f"Unsupported codec: {codec}")
+    return DECODERS[codec](sample_rate = sample_rate, channels = channels)
@@ -0,0 +1,170 @@
+import logging
+logging.basicConfig(level = logging.WARNING, format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+import os
+import re
+import json
+import time
+
+import fire
+import torch
+import soundfile
+import numpy as np
+
+from src.codec import resample
+from src.models import VADModel, ASRModel, load_all
+
+
+# 对比各推理后端在参考集上的精度与速度
+# 参考集：wav_dir 下的音频文件，以及 kaldi 格式的标注文件（每行 "<文件名去掉扩展名> <文本>"）
+
+
+def load_references(wav_dir, text_path):
+    texts = {}
+    if text_path and os.path.exists(text_path):
+        with open(text_path, "r", encoding = "utf-8") as f:
+            for line in f:
+                parts = line.strip().split(maxsplit = 1)
+                if len(parts) == 2:
+                    texts[parts[0]] = parts[1]
+    refs = []
+    for file in sorted(os.listdir(wav_dir)):
+        name, ext = os.path.splitext(file)
+        if ext.lower() not in [".wav", ".flac"]:
+            continue
+        samples, sample_rate = soundfile.read(os.path.join(wav_dir, file), dtype = "float32", always_2d = True)
+        samples = resample(samples.mean(axis = 1), sample_rate).astype(np.float32)
+        refs.append({"name": name, "speech": samples, "text": texts.get(name)})
+    if len(refs) == 0:
+        raise Exception(f"No audio found in {wav_dir}!")
+    return refs
+
+
+def normalize(text):
+    # 去掉标点与空白后按字比较
+    return re.sub(r"[\W_]", "", text).lower()
+
+
+def edit_distance(ref, hyp):
+    row = list(range(len(hyp)+1))
+    for i in range(1, len(ref)+1):
+        prev, row[0] = row[0], i
+        for j in range(1, len(hyp)+1):
+            prev, row[j] = row[j], min(row[j]+1, row[j-1]+1, prev+(ref[i-1] != hyp[j-1]))
+    return row[-1]
+
+
+def timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter()-start_time
+
+
+def smoke_check(backend, asr_model, refs):
+    # 批量输入与 use_itn 在各后端都要生效：每条结果都带有语种/情感/事件/ITN 标签，ITN 标签与参数一致
+    speeches = [ref["speech"] for ref in refs[: 2]]
+    speeches = (speeches*2)[: 2]
+    for use_itn, tag in [(True, "<|withitn|>"), (False, "<|woitn|>")]:
+        texts = asr_model.recognize(speeches, use_itn = use_itn)
+        if len(texts) != len(speeches):
+            raise Exception(f"[{backend}] {len(speeches)} speeches in, {len(texts)} results out")
+        for text in texts:
+            if len(re.findall(r"<\|[^\|]*\|>", text)) < 4 or tag not in text:
+                raise Exception(f"[{backend}] expected rich tags with {tag} (use_itn={use_itn}), got: {text!r}")
+
+
+def run_backend(backend, refs, model_root, batch_size, repeat):
+    vad_model = VADModel(os.path.join(model_root, "speech_fsmn_vad_zh-cn-16k-common-pytorch"), backend = backend)
+    asr_model = ASRModel(os.path.join(model_root, "speech_campplus_sv_zh_en_16k-common_advanced"),
+                         os.path.join(model_root, "SenseVoiceSmall"),
+                         os.path.join(model_root, "punc_ct-transformer_zh-cn-common-vocab272727-pytorch"),
+                         "./speakers", logger = logger,
+                         backends = {"spk": backend, "asr": backend, "pun": backend})
+    _, load_seconds = timed(load_all, [vad_model.loader, vad_model.offline_loader]+[asr_model.loaders[feature] for feature in ["spk", "asr", "pun"]])
+    vad_model.warmup()
+    asr_model.warmup(["spk", "asr", "pun"])
+    smoke_check(backend, asr_model, refs)
+    audio_seconds = sum(len(ref["speech"]) for ref in refs)/16000
+    speeches = [ref["speech"] for ref in refs]
+    costs = {"vad": 0., "spk": 0., "asr": 0., "pun": 0.}
+    with torch.no_grad():
+        for _ in range(repeat):
+            segments = []
+            for speech in speeches:
+                res, cost = timed(vad_model.segment, speech)
+                segments.append(res)
+                costs["vad"] += cost
+            embeddings = []
+            for speech in speeches:
+                res, cost = timed(asr_model.embed, speech)
+                embeddings.append(res)
+                costs["spk"] += cost
+            texts = []
+            for k in range(0, len(speeches), batch_size):
+                res, cost = timed(asr_model.recognize, speeches[k: k+batch_size])
+                texts.extend(asr_model.format_text_and_patterns(text)[0] for text in res)
+                costs["asr"] += cost
+            puncs, cost = timed(asr_model.pun_model.generate, [normalize(text) or "。" for text in texts])
+            costs["pun"] += cost
+    return {
+        "load_seconds": round(load_seconds, 2),
+        "rtf": {stage: round(cost/repeat/audio_seconds, 4) for stage, cost in costs.items()},
+        "segments": segments,
+        "embeddings": embeddings,
+        "texts": texts,
+        "puncs": [res["text"] for res in puncs]
+    }
+
+
+def compare(refs, outputs, baseline):
+    base = outputs[baseline]
+    report = {}
+    for backend, output in outputs.items():
+        errors = chars = 0
+        for ref, text in zip(refs, output["texts"]):
+            if ref["text"] is not None:
+                errors += edit_distance(normalize(ref["text"]), normalize(text))
+                chars += len(normalize(ref["text"]))
+        # 与基准后端的一致性：识别文本的字错误率、说话人向量的余弦相似度、VAD 段数差异、标点一致率
+        diff = sum(edit_distance(normalize(b), normalize(t)) for b, t in zip(base["texts"], output["texts"]))
+        total = max(sum(len(normalize(b)) for b in base["texts"]), 1)
+        sims = [float(np.dot(a, b)/(np.linalg.norm(a)*np.linalg.norm(b)+1e-8))
+                for a, b in zip(base["embeddings"], output["embeddings"])]
+        report[backend] = {
+            "load_seconds": output["load_seconds"],
+            "rtf": output["rtf"],
+            "speedup": {stage: round(base["rtf"][stage]/max(output["rtf"][stage], 1e-8), 2) for stage in output["rtf"]},
+            "cer": round(errors/chars, 4) if chars else None,
+            f"cer_vs_{baseline}": round(diff/total, 4),
+            f"spk_cosine_vs_{baseline}": {"mean": round(float(np.mean(sims)), 4), "min": round(float(np.min(sims)), 4)},
+            f"vad_segments_diff_vs_{baseline}": sum(abs(len(a)-len(b)) for a, b in zip(base["segments"], output["segments"])),
+            f"pun_agreement_vs_{baseline}": round(float(np.mean([a == b for a, b in zip(base["puncs"], output["puncs"])])), 4)
+        }
+    return report
+
+
+def main(wav_dir, text = None, backends = "torch,onnx", model_root = "Path_to_Model's_Dir",
+         batch_size = 8, repeat = 1, threads = None, output = None):
+    if threads:
+        torch.set_num_threads(threads)
+    backends = backends.split(",") if isinstance(backends, str) else list(backends)
+    refs = load_references(wav_dir, text or os.path.join(wav_dir, "text"))
+    outputs = {}
+    for backend in backends:
+        outputs[backend] = run_backend(backend, refs, model_root, batch_size, repeat)
+    result = {
+        "wav_dir": wav_dir,
+        "files": len(refs),
+        "audio_seconds": round(sum(len(ref["speech"]) for ref in refs)/16000, 2),
+        "threads": torch.get_num_threads(),
+        "backends": compare(refs, outputs, backends[0])
+    }
+    print(json.dumps(result, ensure_ascii = False, indent = 2))
+    if output:
+        with open(output, "w", encoding = "utf-8") as f:
+            json.dump(result, f, ensure_ascii = False, indent = 2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
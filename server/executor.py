@@ -0,0 +1,65 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from src.metrics import EXECUTOR_WAIT_TIME, EXECUTOR_EXEC_TIME
+
+
+class InferenceExecutor:
+
+    def __init__(self, max_workers = 1, name = "inference", logger = None):
+        self.max_workers = max_workers
+        self.name = name
+        self.logger = logger
+        self.pool = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = name)
+        self.stats = {}
+
+    def call(self, submit_time, func, args, kwargs):
+        start_time = time.monotonic()
+        result = func(*args, **kwargs)
+        return result, start_time-submit_time, time.monotonic()-start_time
+
+    def record(self, tag, wait_time, exec_time):
+        stats = self.stats.setdefault(tag, {
+            "count": 0,
+            "wait_time": 0., "max_wait_time": 0.,
+            "exec_time": 0., "max_exec_time": 0.
+        })
+        stats["count"] += 1
+        stats["wait_time"] += wait_time
+        stats["max_wait_time"] = max(stats["max_wait_time"], wait_time)
+        stats["exec_time"] += exec_time
+        stats["max_exec_time"] = max(stats["max_exec_time"], exec_time)
+
+    async def run(self, tag, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        submit_time = time.monotonic()
+        result, wait_time, exec_time = await loop.run_in_executor(self.pool, self.call, submit_time, func, args, kwargs)
+        self.record(tag, wait_time, exec_time)
+        EXECUTOR_WAIT_TIME.labels(self.name, tag).observe(wait_time)
+        EXECUTOR_EXEC_TIME.labels(self.name, tag).observe(exec_time)
+        if self.logger:
+            self.logger.debug(f"[{self.name}] {tag}: wait {wait_time*1000:.1f} ms, exec {exec_time*1000:.1f} ms")
+        return result
+
+    def report(self, ):
+        report = {}
+        for tag, stats in self.stats.items():
+            count = max(stats["count"], 1)
+            report[tag] = {
+                "count": stats["count"],
+                "avg_wait_ms": round(stats["wait_time"]/count*1000, 2),
+                "max_wait_ms": round(stats["max_wait_time"]*1000, 2),
+                "avg_exec_ms": round(stats["exec_time"]/count*1000, 2),
+                "max_exec_ms": round(stats["max_exec_time"]*1000, 2)
+            }
+        return report
+
+    def shutdown(self, ):
+        self.pool.shutdown(wait = False, cancel_futures = True)
+
+
+async def submit(executor, tag, func, *args, **kwargs):
+    if executor is None:
+        return func(*args, **kwargs)
+    return await executor.run(tag, func, *args, **kwargs)
@@ -0,0 +1,181 @@
+import bisect
+
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+RTF_BUCKETS = (.01, .02, .05, .1, .2, .3, .5, .75, 1., 2.)
+
+
+def format_labels(pairs):
+    if len(pairs) == 0:
+        return ""
+    labels = ",".join(f'{name}="{str(value)}"' for name, value in pairs)
+    return "{"+labels+"}"
+
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            child = self.children[labelvalues] = self.new_child()
+        return child
+
+    def new_child(self, ):
+        raise NotImplementedError
+
+    def samples(self, ):
+        raise NotImplementedError
+
+    def header(self, ):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def lines(self, labels = ()):
+        # labels: 附加在每个样本上的标签，例如多进程部署时的 worker 编号
+        return [f"{self.name}{suffix}{format_labels(list(labels)+pairs)} {value}" for suffix, pairs, value in self.samples()]
+
+    def render(self, ):
+        return "\n".join(self.header()+self.lines())
+
+
+class Value:
+
+    def __init__(self, ):
+        self.value = 0.
+
+    def inc(self, amount = 1.):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def new_child(self, ):
+        return Value()
+
+    def inc(self, amount = 1.):
+        self.labels().inc(amount)
+
+    def samples(self, ):
+        for labelvalues, child in self.children.items():
+            yield "_total", list(zip(self.labelnames, labelvalues)), child.value
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames = (), func = None):
+        super().__init__(name, documentation, labelnames)
+        self.func = func    # func() -> {labelvalues: value}，在采集时计算
+
+    def new_child(self, ):
+        return Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def samples(self, ):
+        children = {labelvalues: child.value for labelvalues, child in self.children.items()}
+        if self.func is not None:
+            children.update(self.func())
+        for labelvalues, value in children.items():
+            yield "", list(zip(self.labelnames, labelvalues)), value
+
+
+class Buckets:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames = (), buckets = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self, ):
+        return Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self, ):
+        for labelvalues, child in self.children.items():
+            pairs = list(zip(self.labelnames, labelvalues))
+            total = 0
+            for bound, count in zip(self.buckets+(float("inf"), ), child.counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield "_bucket", pairs+[("le", le)], total
+            yield "_sum", pairs, child.sum
+            yield "_count", pairs, total
+
+
+class Registry:
+
+    def __init__(self, ):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, ):
+        return "\n".join(metric.render() for metric in self.metrics)+"\n"
+
+    def snapshot(self, labels = ()):
+        return {metric.name: metric.lines(labels) for metric in self.metrics}
+
+    def render_snapshots(self, snapshots):
+        # 合并多个进程的快照，同一指标的样本放在同一组 HELP/TYPE 下
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            for snapshot in snapshots:
+                lines.extend(snapshot.get(metric.name, []))
+        return "\n".join(lines)+"\n"
+
+
+REGISTRY = Registry()
+
+VAD_STEP_TIME = REGISTRY.register(Histogram(
+    "stt_vad_step_seconds", "Time of one streaming VAD step of a session, including batching wait"))
+STAGE_TIME = REGISTRY.register(Histogram(
+    "stt_stage_seconds", "Time of one model stage call (spk, asr, pun, corrector, post)", ["stage"]))
+EXECUTOR_WAIT_TIME = REGISTRY.register(Histogram(
+    "stt_executor_wait_seconds", "Queue wait time in an inference executor", ["executor", "tag"]))
+EXECUTOR_EXEC_TIME = REGISTRY.register(Histogram(
+    "stt_executor_exec_seconds", "Execution time in an inference executor", ["executor", "tag"]))
+RESULT_LATENCY = REGISTRY.register(Histogram(
+    "stt_end_of_speech_to_result_seconds", "Latency from VAD end of speech to the final result"))
+REAL_TIME_FACTOR = REGISTRY.register(Histogram(
+    "stt_real_time_factor", "ASR processing time divided by utterance duration", buckets = RTF_BUCKETS))
+UTTERANCES = REGISTRY.register(Counter(
+    "stt_utterances", "Utterances by result type", ["type"]))
+BYTES_IN = REGISTRY.register(Counter(
+    "stt_bytes_received", "Bytes received from clients"))
+BYTES_OUT = REGISTRY.register(Counter(
+    "stt_bytes_sent", "Bytes sent to clients"))
+SESSIONS_CLOSED = REGISTRY.register(Counter(
+    "stt_sessions_closed", "Closed websocket sessions by reason (idle, stage name or exception type)", ["reason"]))
@@ -1,77 +1,237 @@
 import os
 import re
+import copy
+import time
 import base64
 import httpx
 import asyncio
+import threading
 from openai import AsyncOpenAI
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import soundfile
 import numpy as np
-from funasr import AutoModel
 from pycorrector import Corrector
 
+from src.executor import submit
+from src.backends import load_model, TORCH, BACKENDS
+from src.speakers import SpeakerStore
+from src.postprocess import PostProcessor
+from src.metrics import STAGE_TIME
+
+
+class LazyLoader:
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.value = None
+        self.lock = threading.Lock()
+        # funasr AutoModel 每次推理都会修改实例上共享的 kwargs（cache、use_itn、batch_size 等），
+        # 同一个模型实例不能被多个线程同时调用，所有推理调用都要持有这把锁
+        self.infer_lock = threading.Lock()
+
+    @property
+    def loaded(self, ):
+        return self.value is not None
+
+    def get(self, ):
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    self.value = self.loader()
+        return self.value
+
+
+def load_all(loaders):
+    # 并行加载多个模型
+    loaders = [loader for loader in loaders if not loader.loaded]
+    if len(loaders) == 0:
+        return
+    with ThreadPoolExecutor(max_workers = len(loaders)) as pool:
+        list(pool.map(LazyLoader.get, loaders))
+
 
 class VADModel:
 
-    def __init__(self, model_path, max_end_silence_time = 200, speech_noise_thres = 0.8):
-        self.model = AutoModel(
-            model = model_path, 
+    def __init__(self, model_path, max_end_silence_time = 200, speech_noise_thres = 0.8, executor = None, 
+                 backend = TORCH):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unsupported backend: {backend}")
+        self.executor = executor
+        self.backend = backend
+        load = lambda: load_model(
+            "vad", model_path, backend, 
             max_end_silence_time = max_end_silence_time, 
-            speech_noise_thres = speech_noise_thres, 
-            disable_pbar = True
+            speech_noise_thres = speech_noise_thres
         )
+        self.loader = LazyLoader(load)
+        # 离线切分使用独立的模型实例（VAD 模型很小），长音频不会占住实时会话的推理锁
+        self.offline_loader = LazyLoader(load)
+
+    @property
+    def model(self, ):
+        return self.loader.get()
+
+    def load(self, ):
+        self.loader.get()
+
+    def warmup(self, ):
+        chunk = np.random.uniform(-0.01, 0.01, 3200).astype(np.float32)
+        result = self.step([(chunk, 200, {}, 0)])[0]
+        if isinstance(result, Exception):
+            raise result
 
     def cut(self, chunk, chunk_size, offset, start, end):
         start_or_end = None
+        align = 2 if isinstance(chunk, bytes) else 1 # bytes 输入按 int16 对齐，数组输入按采样点计
         if start < 0:
             i = -1
             start_or_end = False # 语音结束
         else:
             i = len(chunk)*(start-offset)//chunk_size
-            if i % 2 == 1:
-                i -= 1
+            i -= i % align
         if end < 0:
             j = -1
             start_or_end = True # 语音开始
         else:
             j = len(chunk)*(end-offset)//chunk_size
-            if j % 2 == 1:
-                j += 1
+            j += -j % align
         return (start_or_end, i, j, start, end, offset)
 
+    def step(self, requests):
+        # 逐会话推进，某个会话出错时返回异常对象，不影响同批的其它会话
+        results = []
+        model = self.model
+        with torch.no_grad(), self.loader.infer_lock:
+            for chunk, chunk_size, cache, offset in requests:
+                try:
+                    res = model.generate(input = chunk, chunk_size = chunk_size, cache = cache, is_final = False)
+                except Exception as e:
+                    results.append(e)
+                    continue
+                chunks = []
+                for start, end in res[0]["value"]:
+                    chunks.append(self.cut(chunk, chunk_size, offset, start, end))
+                results.append(chunks)
+        return results
+
     async def infer(self, chunk, chunk_size, cache, offset):
-        res = self.model.generate(input = chunk, chunk_size = chunk_size, cache = cache, is_final = False)
-        chunks = []
-        for start, end in res[0]["value"]:
-            chunks.append(self.cut(chunk, chunk_size, offset, start, end))
-        return chunks
+        results = await self.infer_batch([(chunk, chunk_size, cache, offset)])
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0]
+
+    async def infer_batch(self, requests):
+        return await submit(self.executor, "vad", self.step, requests)
+
+    def segment(self, audio):
+        # 离线模式：整段音频一次送入，返回 [[start_ms, end_ms], ...]
+        model = self.offline_loader.get()
+        with torch.no_grad(), self.offline_loader.infer_lock:
+            res = model.generate(input = audio)
+        return [(start, end) for start, end in res[0]["value"]]
+
+    async def infer_offline(self, audio, executor = None):
+        # 长音频的单次调用耗时较长，可以放到独立的线程池，避免阻塞实时会话
+        return await submit(executor or self.executor, "vad_offline", self.segment, audio)
 
 
 class ASRModel:
 
-    def __init__(self, spk_model_path, asr_model_path, pun_model_path, speakers_path):
-        self.spk_model = AutoModel(model = spk_model_path, disable_pbar = True)
-        self.asr_model = AutoModel(model = asr_model_path, disable_pbar = True)
-        self.pun_model = AutoModel(model = pun_model_path, disable_pbar = True)
-        self.corrector = Corrector()
-        self.reg_spks = self.reg_spks_init(speakers_path)
-
-    def reg_spks_init(self, speakers_path):
-        reg_spks = {}
-        for file in os.listdir(speakers_path):
-            file_path = os.path.join(speakers_path, file)
-            spk, base = os.path.splitext(os.path.basename(file))
-            if os.path.isfile(file_path) and base in [".wav"]:
-                data, sample_rate = soundfile.read(file_path, dtype = "float32")
-                embedding = self.spk_model.generate(data)[0]["spk_embedding"].flatten()
-                embedding /= torch.norm(embedding)
-                reg_spks[spk] = {
-                    "data": data,
-                    "sample_rate": sample_rate, 
-                    "embedding": embedding
-                }
-        return reg_spks
+    def __init__(self, spk_model_path, asr_model_path, pun_model_path, speakers_path, executor = None, 
+                 postprocess_config = None, logger = None, backends = None):
+        # backends: {"spk"/"asr"/"pun": 后端}，未指定的模型使用 torch
+        self.backends = {feature: TORCH for feature in ["spk", "asr", "pun"]}
+        self.backends.update(backends or {})
+        for backend in self.backends.values():
+            if backend not in BACKENDS:
+                raise ValueError(f"Unsupported backend: {backend}")
+        self.executor = executor
+        self.loaders = {
+            "spk": LazyLoader(lambda: load_model("spk", spk_model_path, self.backends["spk"])), 
+            "asr": LazyLoader(lambda: load_model("asr", asr_model_path, self.backends["asr"])), 
+            "pun": LazyLoader(lambda: load_model("pun", pun_model_path, self.backends["pun"])), 
+            "corrector": LazyLoader(Corrector)
+        }
+        self.postprocessor = PostProcessor(self.loaders["pun"], self.loaders["corrector"], executor = executor, logger = logger, 
+                                           **(postprocess_config or {}))
+        self.speaker_store = SpeakerStore(speakers_path, self.embed)
+        self.loaders["speakers"] = LazyLoader(self.speaker_store.load)
+
+    @property
+    def spk_model(self, ):
+        return self.loaders["spk"].get()
+
+    @property
+    def asr_model(self, ):
+        return self.loaders["asr"].get()
+
+    @property
+    def pun_model(self, ):
+        return self.loaders["pun"].get()
+
+    @property
+    def corrector(self, ):
+        return self.loaders["corrector"].get()
+
+    @property
+    def reg_spks(self, ):
+        return self.loaders["speakers"].get()
+
+    @reg_spks.setter
+    def reg_spks(self, reg_spks):
+        self.loaders["speakers"].value = reg_spks
+
+    def load(self, features):
+        # features: 需要预加载的模型，其余模型在首次使用时加载
+        load_all([self.loaders[feature] for feature in features if feature != "speakers"])
+        if "spk" in features:
+            self.loaders["speakers"].get()
+
+    def warmup(self, features):
+        speech = np.random.uniform(-0.01, 0.01, 16000).astype(np.float32)
+        if "spk" in features:
+            self.embed(speech)
+        if "asr" in features:
+            self.recognize([speech])
+        if "pun" in features:
+            self.postprocessor.pun_batcher.punctuate(["你好"])
+        if "corrector" in features:
+            self.postprocessor.cor_batcher.correct(["你好"])
+
+    def generate(self, feature, *args, **kwargs):
+        model = self.loaders[feature].get()
+        with self.loaders[feature].infer_lock:
+            return model.generate(*args, **kwargs)
+
+    def embed(self, data):
+        return self.generate("spk", data)[0]["spk_embedding"].flatten().cpu().numpy()
+
+    def list_speakers(self, ):
+        return list(self.reg_spks)
+
+    def enroll_speaker(self, name, audio, replace = True):
+        # 在登记线程中调用，先加载存储中已有的说话人，否则会基于空的清单覆盖存储
+        reg_spks = self.loaders["speakers"].get()
+        if not replace and name in reg_spks:
+            raise FileExistsError(name)
+        self.reg_spks = self.speaker_store.enroll(name, audio)
+        return len(self.reg_spks)
+
+    def delete_speaker(self, name):
+        self.loaders["speakers"].get() # 同上，先加载已有的说话人
+        self.reg_spks = self.speaker_store.delete(name)
+        return len(self.reg_spks)
+
+    def refresh_speakers(self, ):
+        if not self.loaders["speakers"].loaded:
+            return False
+        reg_spks = self.speaker_store.refresh()
+        if reg_spks is None:
+            return False
+        self.reg_spks = reg_spks
+        return True
 
     def format_text_and_patterns(self, text):
         regex = r"<\|[^\|]*\|>"
@@ -92,64 +252,179 @@ class ASRModel:
         text = " ".join(texts)
         return text, patterns
 
-    async def infer(self, speech, 
-                    speaker_verify = None, threshold = 0.5, language_check = True, 
-                    use_itn = True, add_punctuations = True, use_corrector = True):
+    def empty_result(self, ):
         result = {}
         result["speaker_verify_result"] = None
         result["speaker_verify_info"] = None
         result["scores"] = None
         result["check_language"] = None
         result["corrector"] = None
-        if speaker_verify:
-            targets = []
-            for spk in self.reg_spks:
-                if spk.startswith(speaker_verify):
-                    targets.append(spk)
-            if len(targets) == 0:
-                result["speaker_verify_info"] = f"{speaker_verify} not found!"
-                result["raw_text"] = ""
-                result["text"] = ""
-                return result
-            source = self.spk_model.generate(speech)[0]["spk_embedding"].flatten()
-            source /= torch.norm(source)
-            sims, max_spk, max_sim = {}, None, 0.
-            for spk in targets:
-                target = self.reg_spks[spk]["embedding"]
-                sim = float((1.+torch.sum(source*target))/2)
-                sims[spk] = np.round(sim, 3)
-                if sim > max_sim:
-                    max_sim = sim
-                    max_spk = spk
-                if sim >= threshold:
-                    result["speaker_verify_result"] = True
-                    result["speaker_verify_info"] = f"{speaker_verify} hit with {spk}: score_from_{spk} = {sim:.2f} >= {threshold:.2f}"
-                    result["scores"] = sims
-                    break
-            else:
-                result["speaker_verify_result"] = False
-                result["speaker_verify_info"] = f"{speaker_verify} not hit: max_score_from_{max_spk} = {max_sim:.2f} < {threshold:.2f}"
-                result["scores"] = sims
-                result["raw_text"] = ""
-                result["text"] = ""
-                return result
-        text = self.asr_model.generate(speech, use_itn = use_itn)[0]["text"]
+        result["timings"] = {}
+        return result
+
+    def verify(self, speech, result, speaker_verify, threshold = 0.5):
+        reg_spks = self.reg_spks # 登记接口会整体替换索引，这里固定使用当前快照
+        lo, hi = reg_spks.search(speaker_verify)
+        if lo == hi:
+            result["speaker_verify_info"] = f"{speaker_verify} not found!"
+            return False
+        source = self.generate("spk", speech)[0]["spk_embedding"]
+        scores = reg_spks.score(source, lo, hi)
+        hits = torch.nonzero(scores >= threshold).flatten()
+        # 与逐个比对一致：命中第一个超过阈值的说话人即停止
+        n = int(hits[0])+1 if len(hits) > 0 else len(scores)
+        sims = {spk: np.round(sim, 3) for spk, sim in zip(reg_spks.names[lo: lo+n], scores[: n].tolist())}
+        if len(hits) > 0:
+            spk, sim = reg_spks.names[lo+n-1], float(scores[n-1])
+            result["speaker_verify_result"] = True
+            result["speaker_verify_info"] = f"{speaker_verify} hit with {spk}: score_from_{spk} = {sim:.2f} >= {threshold:.2f}"
+            result["scores"] = sims
+            return True
+        k = int(torch.argmax(scores))
+        max_spk, max_sim = reg_spks.names[lo+k], float(scores[k])
+        result["speaker_verify_result"] = False
+        result["speaker_verify_info"] = f"{speaker_verify} not hit: max_score_from_{max_spk} = {max_sim:.2f} < {threshold:.2f}"
+        result["scores"] = sims
+        return False
+
+    def recognize(self, speeches, use_itn = True):
+        res = self.generate("asr", speeches, use_itn = use_itn, batch_size = len(speeches))
+        return [r["text"] for r in res]
+
+    def check(self, text, result, language_check = True):
         result["raw_text"] = text
         if language_check:
             if not ("<|zh|>" in text or "<|en|>" in text): # 只允许中文和英文
                 result["check_language"] = False
                 result["text"] = ""
-                return result
+                return None
             else:
                 result["check_language"] = True
-        text, patterns = self.format_text_and_patterns(text)
-        if text and add_punctuations and not use_itn:
-            text = self.pun_model.generate(text)[0]["text"]
-        if text and use_corrector:
-            res = self.corrector.correct(text)
-            result["corrector"] = res["errors"]
-            text = res["target"]
-        text = text + patterns
+        return self.format_text_and_patterns(text)
+
+    async def postprocess(self, text, patterns, result, 
+                          use_itn = True, add_punctuations = True, use_corrector = True, capped = True, postprocessor = None):
+        start_time = time.perf_counter()
+        postprocessor = postprocessor or self.postprocessor
+        text, errors = await postprocessor.process(text, add_punctuations and not use_itn, use_corrector, capped)
+        if use_corrector:
+            result["corrector"] = errors
+        result["text"] = text + patterns
+        cost = time.perf_counter()-start_time
+        STAGE_TIME.labels("post").observe(cost)
+        result["timings"]["post"] = round(cost*1000, 1)
+        return result
+
+    def measure(self, func, *args, **kwargs):
+        # 在推理线程内计时，不含排队等待（等待时间由 executor 单独记录）
+        start_time = time.perf_counter()
+        res = func(*args, **kwargs)
+        return res, time.perf_counter()-start_time
+
+    async def timed(self, stage, timings, func, *args, executor = None, **kwargs):
+        res, cost = await submit(executor or self.executor, stage, self.measure, func, *args, **kwargs)
+        STAGE_TIME.labels(stage).observe(cost)
+        cost = round(cost*1000, 1)
+        for timing in timings:
+            timing[stage] = cost
+        return res
+
+    async def infer(self, speech, 
+                    speaker_verify = None, threshold = 0.5, language_check = True, 
+                    use_itn = True, add_punctuations = True, use_corrector = True, speculative = False, 
+                    fast_postprocess = False):
+        option = {
+            "speaker_verify": speaker_verify, 
+            "threshold": threshold, 
+            "language_check": language_check, 
+            "use_itn": use_itn, 
+            "add_punctuations": add_punctuations, 
+            "use_corrector": use_corrector, 
+            "speculative": speculative, 
+            "fast_postprocess": fast_postprocess
+        }
+        results = await self.infer_batch([speech], [option])
+        return results[0]
+
+    async def infer_partial(self, speech, speaker_verify = None, threshold = 0.5, use_itn = True):
+        # 中间结果只做识别和格式化，标点与纠错留给最终结果
+        result = self.empty_result()
+        if speaker_verify:
+            verified = await self.timed("spk", [result["timings"]], self.verify, speech, result, speaker_verify, threshold)
+            if not verified:
+                result["raw_text"] = ""
+                result["text"] = ""
+                return result
+        texts = await self.timed("asr", [result["timings"]], self.recognize, [speech], use_itn = use_itn)
+        result["raw_text"] = texts[0]
+        text, patterns = self.format_text_and_patterns(texts[0])
         result["text"] = text
         return result
 
+    async def decode(self, speeches, options, ks, results, executor = None):
+        groups = {} # 按 use_itn 分组后批量送入 ASR 模型
+        for k in ks:
+            groups.setdefault(options[k].get("use_itn", True), []).append(k)
+        texts = {}
+        for use_itn, ks in groups.items():
+            res = await self.timed("asr", [results[k]["timings"] for k in ks], self.recognize, 
+                                   [speeches[k] for k in ks], use_itn = use_itn, executor = executor)
+            texts.update(zip(ks, res))
+        return texts
+
+    async def infer_batch(self, speeches, options, executor = None, postprocessor = None):
+        # executor/postprocessor: 离线转写使用独立的线程池与后处理，不占用实时会话的资源
+        start_time = time.perf_counter()
+        results = [self.empty_result() for _ in speeches]
+        verify_ks, verify_tasks = [], []
+        for k, (speech, option) in enumerate(zip(speeches, options)):
+            speaker_verify = option.get("speaker_verify")
+            if speaker_verify:
+                verify_ks.append(k)
+                verify_tasks.append(self.timed("spk", [results[k]["timings"]], self.verify, 
+                                               speech, results[k], speaker_verify, option.get("threshold", 0.5), 
+                                               executor = executor))
+        # 推测解码：ASR 与说话人验证同时进行，验证失败时丢弃识别结果
+        eager_ks = [k for k in range(len(speeches)) if k not in verify_ks or options[k].get("speculative")]
+        eager_task = asyncio.ensure_future(self.decode(speeches, options, eager_ks, results, executor))
+        try:
+            verified = dict(zip(verify_ks, await asyncio.gather(*verify_tasks)))
+        except BaseException:
+            eager_task.cancel()
+            raise
+        for k, passed in verified.items():
+            if not passed:
+                results[k]["raw_text"] = ""
+                results[k]["text"] = ""
+        texts = await eager_task
+        texts.update(await self.decode(speeches, options, [k for k in verify_ks if verified[k] and k not in texts], results, 
+                                       executor))
+        post_tasks = []
+        for k, text in texts.items():
+            if not verified.get(k, True):
+                continue
+            option = options[k]
+            formatted = self.check(text, results[k], option.get("language_check", True))
+            if formatted is None:
+                continue
+            text, patterns = formatted
+            use_itn = option.get("use_itn", True)
+            add_punctuations = option.get("add_punctuations", True)
+            use_corrector = option.get("use_corrector", True)
+            if option.get("fast_postprocess") and text and (use_corrector or add_punctuations and not use_itn):
+                # 快速通道：先返回未纠错文本，纠错后的文本作为后续消息发送，后续消息不受 max_latency 限制
+                followup = copy.deepcopy(results[k])
+                followup["revision"] = 1
+                results[k]["text"] = text + patterns
+                results[k]["revision"] = 0
+                results[k]["followup"] = asyncio.ensure_future(
+                    self.postprocess(text, patterns, followup, use_itn, add_punctuations, use_corrector, capped = False, 
+                                     postprocessor = postprocessor))
+            else:
+                post_tasks.append(self.postprocess(text, patterns, results[k], use_itn, add_punctuations, use_corrector, 
+                                                   postprocessor = postprocessor))
+        await asyncio.gather(*post_tasks)
+        total = round((time.perf_counter()-start_time)*1000, 1)
+        for result in results:
+            result["timings"]["total"] = total
+        return results
@@ -1,11 +1,17 @@
 import re
 import json
+import time
 import zhon
 import string
 import httpx
 import asyncio
 import numpy as np
 
+from src.buffer import AudioBuffer
+from src.executor import submit
+from src.metrics import VAD_STEP_TIME, RESULT_LATENCY, REAL_TIME_FACTOR, UTTERANCES, BYTES_IN, BYTES_OUT
+from src.protocol import message, LegacyEncoder, VAD_START, VAD_END, PARTIAL, FINAL, ERROR
+
 
 INPUT_CHANNELS = 1           # 接收信号的通道数
 INPUT_SAMPLE_RATE = 16000    # 接收信号的采样率
@@ -29,17 +35,61 @@ VAD_CHUNK_SIZE = int(VAD_TIME_INTERVAL*INPUT_SAMPLE_RATE/1000)
 # VAD 检测帧数转化为字节数
 VAD_BYTE_SIZE = VAD_CHUNK_SIZE*INPUT_CHANNELS*2
 
+VAD_BUFFER_TIME = 60         # 音频缓冲区容量上限 (s)，超长语音会被截断
+VAD_LOOKBACK_TIME = 1000     # 无语音时保留的历史音频长度 (ms)，用于回溯语音起点
+
+# VAD 缓冲区容量转化为采样点数
+VAD_BUFFER_SIZE = VAD_BUFFER_TIME*INPUT_SAMPLE_RATE*INPUT_CHANNELS
+
+# VAD 回溯长度转化为采样点数
+VAD_LOOKBACK_SIZE = int(VAD_LOOKBACK_TIME*INPUT_SAMPLE_RATE/1000)*INPUT_CHANNELS
+
+# 缓冲区初始大小：回溯部分加上待检测的窗口，语音变长时按需扩容到 VAD_BUFFER_SIZE
+VAD_BUFFER_INITIAL_SIZE = VAD_LOOKBACK_SIZE+2*VAD_CHUNK_SIZE*INPUT_CHANNELS
+
+PARTIAL_INTERVAL = 600       # 中间结果的最小识别间隔 (ms)
+PARTIAL_WINDOW = 8000        # 中间结果每次重新识别的最大音频长度 (ms)，更早的部分固定不再识别
+
+# 中间结果识别窗口转化为采样点数
+PARTIAL_WINDOW_SIZE = int(PARTIAL_WINDOW*INPUT_SAMPLE_RATE/1000)*INPUT_CHANNELS
+
+
+def samples_to_ms(samples):
+    return samples*1000//(INPUT_SAMPLE_RATE*INPUT_CHANNELS)
+
+
+def is_optional(item):
+    # 过载时可以丢弃的条目：中间结果与 VAD 结束标记
+    return isinstance(item, dict) and item.get("type") in [PARTIAL, VAD_END]
+
+
+def merge_segments(old, new):
+    if old["type"] == PARTIAL:
+        return new
+    if new["type"] == PARTIAL:
+        return old
+    # 两段待识别的语音合并为一段，沿用前一段的编号
+    return {"type": FINAL, "speech": np.concatenate([old["speech"], new["speech"]]), 
+            "utt": old["utt"], "start": old["start"], "end": new["end"], "time": new["time"]}
+
 
 class Input:
 
-    def __init__(self, websocket, inp_queue, logger = None):
+    def __init__(self, websocket, inp_queue, logger = None, decoder = None, executor = None):
         self.websocket = websocket
         self.inp_queue = inp_queue
         self.logger = logger
+        self.decoder = decoder
+        self.executor = executor
+        self.last_active = time.monotonic()
 
     async def run(self, ):
         while True:
             data = await self.websocket.receive_bytes()
+            self.last_active = time.monotonic()
+            BYTES_IN.inc(len(data))
+            if self.decoder is not None and not self.decoder.passthrough:
+                data = await submit(self.executor, "decode", self.decoder.decode, data)
             await self.inp_queue.put(data)
             if self.logger:
                 if isinstance(data, bytes):
@@ -50,72 +100,132 @@ class Input:
 
 class Output:
 
-    def __init__(self, websocket, outp_queue, logger = None):
+    def __init__(self, websocket, outp_queue, logger = None, encoder = None):
         self.websocket = websocket
         self.outp_queue = outp_queue
         self.logger = logger
+        self.encoder = encoder or LegacyEncoder()
+        self.seq = 0
+        self.last_active = time.monotonic()
 
     async def run(self, ):
         while True:
-            data = await self.outp_queue.get()
+            msg = await self.outp_queue.get()
             self.outp_queue.task_done()
-            await self.websocket.send_bytes(data)
+            data = self.encoder.encode(msg, self.seq)
+            if data is None:
+                continue
+            self.seq += 1
+            self.last_active = time.monotonic()
+            if isinstance(data, bytes):
+                await self.websocket.send_bytes(data)
+                BYTES_OUT.inc(len(data))
+            else:
+                await self.websocket.send_text(data)
+                BYTES_OUT.inc(len(data.encode("utf-8")))
             if self.logger:
                 if isinstance(data, bytes):
-                    self.logger.info(f"[Output] Sent {len(data)} bytes")
+                    self.logger.info(f"[Output] Sent {msg['type']}: {len(data)} bytes")
                 if isinstance(data, str):
                     self.logger.info(f"[Output] Sent text: {data}")
 
 
 class VAD:
 
-    def __init__(self, model, inp_queue, outp_queue_asr, outp_queue, logger = None):
+    def __init__(self, model, inp_queue, outp_queue_asr, outp_queue, logger = None, 
+                 partial = False, partial_interval = PARTIAL_INTERVAL):
         self.model = model
         self.inp_queue = inp_queue
         self.outp_queue_asr = outp_queue_asr
+        self.outp_queue = outp_queue
+        self.buffer = AudioBuffer(VAD_BUFFER_SIZE, VAD_BUFFER_INITIAL_SIZE)
         self.cache = {}
         self.offset = 0
         self.logger = logger
+        self.partial = partial
+        self.partial_interval = int(partial_interval*INPUT_SAMPLE_RATE/1000)*INPUT_CHANNELS
 
     async def run(self, ):
-        audio_buffer = b""
-        speech_buffer = b""
+        window = VAD_CHUNK_SIZE*INPUT_CHANNELS
+        position = 0 # 下一个 VAD 窗口起点的绝对采样点位置
         start, end = -1, -1
+        last_partial = -1
+        utt = -1 # 当前语音段编号
         while True:
             chunk = await self.inp_queue.get()
             self.inp_queue.task_done()
-            audio_buffer += chunk
-            while len(audio_buffer) >= VAD_BYTE_SIZE:
-                vad_chunk = audio_buffer[: VAD_BYTE_SIZE]
-                small_chunks = await self.model.infer(vad_chunk, VAD_TIME_INTERVAL, self.cache, self.offset)
-                self.offset += VAD_TIME_INTERVAL
-                audio_buffer = audio_buffer[VAD_BYTE_SIZE: ]
-                speech_buffer += vad_chunk
+            self.buffer.write(chunk)
+            while self.buffer.end-position >= window:
+                vad_chunk = self.buffer.view(position, position+window)
+                start_time = time.perf_counter()
+                try:
+                    small_chunks = await self.model.infer(vad_chunk, VAD_TIME_INTERVAL, self.cache, self.offset)
+                except Exception as e:
+                    # 模型状态已不可用：通知客户端，重置状态后从下一个窗口重新检测
+                    if self.logger:
+                        self.logger.error(f"[VAD] Error: {e}")
+                    await self.outp_queue.put(message(ERROR, utt, samples_to_ms(position), samples_to_ms(position+window), 
+                                                      error = str(e)))
+                    self.cache = {}
+                    self.offset = 0 # 新的模型状态从下一个窗口开始计时
+                    start, end = -1, -1
+                    small_chunks = []
+                else:
+                    self.offset += VAD_TIME_INTERVAL
+                VAD_STEP_TIME.observe(time.perf_counter()-start_time)
                 for tag, i, j, s, e, t in small_chunks:
-                    self.logger.info(f"[VAD] vad chunk: {tag}, {i}: {j}, {s}: {e}, {t}")
+                    if self.logger:
+                        self.logger.info(f"[VAD] vad chunk: {tag}, {i}: {j}, {s}: {e}, {t}")
                     if s >= 0:
-                        start = i+len(speech_buffer)-VAD_BYTE_SIZE
-                        await self.outp_queue.put("[VAD Start]")
+                        start = position+i
+                        utt += 1
+                        await self.outp_queue.put(message(VAD_START, utt, samples_to_ms(start)))
                         if self.logger:
                             self.logger.info(f"[VAD] vad start")
                     if e >= 0:
-                        end = j+len(speech_buffer)-VAD_BYTE_SIZE
+                        end = position+j
+                        await self.outp_queue.put(message(VAD_END, utt, samples_to_ms(max(start, 0)), samples_to_ms(end)))
                         if self.logger:
                             self.logger.info(f"[VAD] vad end")
                     if 0 <= start <= end:
-                        speech = speech_buffer[start: end]
-                        await self.outp_queue_asr.put(speech)
-                        speech_buffer = speech_buffer[end: ]
+                        # 缓冲区会被复用，送入 ASR 的语音需要拷贝
+                        speech = self.buffer.view(start, end).copy()
+                        await self.outp_queue_asr.put({"type": FINAL, "speech": speech, "utt": utt, 
+                                                       "start": samples_to_ms(start), "end": samples_to_ms(end), 
+                                                       "time": time.monotonic()})
+                        self.buffer.evict(end)
                         start, end = -1, -1
                         if self.logger:
-                            self.logger.info(f"[VAD] vad length: {len(speech)/INPUT_CHANNELS/INPUT_SAMPLE_RATE/2*1000:.0f} ms")
+                            self.logger.info(f"[VAD] vad length: {len(speech)/INPUT_CHANNELS/INPUT_SAMPLE_RATE*1000:.0f} ms")
+                position += window
+                if self.partial and start >= 0 and position-max(start, last_partial) >= self.partial_interval:
+                    # ASR 仍有积压时跳过本次中间结果
+                    if self.outp_queue_asr.empty():
+                        last_partial = position
+                        speech = self.buffer.view(start, position).copy()
+                        await self.outp_queue_asr.put({"type": PARTIAL, "speech": speech, "utt": utt, 
+                                                       "start": samples_to_ms(start), "end": samples_to_ms(position)})
+                if start >= 0:
+                    self.buffer.evict(start)
+                else:
+                    self.buffer.evict(position-VAD_LOOKBACK_SIZE)
+            if self.buffer.dropped and self.logger:
+                self.logger.warning(f"[VAD] buffer overflow, dropped {self.buffer.dropped} samples")
+                self.buffer.dropped = 0
+
+    def release(self, ):
+        # 会话结束后释放缓冲区与模型状态，不必等待垃圾回收
+        self.buffer = AudioBuffer(0)
+        # 推理线程可能仍在使用原来的 cache，只解除引用，不清空
+        self.cache = {}
 
 
 class ASR:
 
     def __init__(self, model, inp_queue_vad, outp_queue, logger = None, 
                  speaker_verify = None, threshold = 0.5, language_check = True, 
-                 use_itn = True, add_punctuations = True, use_corrector = True):
+                 use_itn = True, add_punctuations = True, use_corrector = True, speculative = False, 
+                 fast_postprocess = False):
         self.model = model
         self.inp_queue_vad = inp_queue_vad
         self.outp_queue = outp_queue
@@ -126,22 +236,100 @@ class ASR:
         self.use_itn = use_itn
         self.add_punctuations = add_punctuations
         self.use_corrector = use_corrector
+        self.speculative = speculative
+        self.fast_postprocess = fast_postprocess
+        self.followups = set()
+
+    async def send_followup(self, segment, followup):
+        result = await followup
+        result["partial"] = False
+        await self.outp_queue.put(message(FINAL, segment["utt"], segment["start"], segment["end"], result = result))
+        if self.logger and result["text"]:
+            self.logger.info(f"[ASR] followup text: {result['text']}")
+
+    async def infer_partial(self, speech):
+        state = self.partial_state
+        if state["verified"] is False:
+            return None
+        if len(speech)-state["committed"] > PARTIAL_WINDOW_SIZE:
+            # 只重新识别最近的窗口，之前的识别结果固定下来
+            state["committed_text"] += state["text"]
+            state["committed"] = state["end"]
+            state["text"] = ""
+        speaker_verify = self.speaker_verify if state["verified"] is None else None
+        result = await self.model.infer_partial(speech[state["committed"]: ], 
+                                                speaker_verify, self.threshold, self.use_itn)
+        if speaker_verify:
+            state["verified"] = result["speaker_verify_result"]
+            if not state["verified"]:
+                return None
+        state["text"] = result["text"]
+        state["end"] = len(speech)
+        result["text"] = state["committed_text"]+state["text"]
+        result["partial"] = True
+        return result
+
+    def reset_partial(self, ):
+        self.partial_state = {"committed": 0, "committed_text": "", "end": 0, "text": "", "verified": None}
+
+    def release(self, ):
+        # 会话结束后不再需要的后续结果直接取消
+        for task in list(self.followups):
+            task.cancel()
+        self.reset_partial()
 
     async def run(self, ):
+        self.reset_partial()
         while True:
-            speech = await self.inp_queue_vad.get()
+            segment = await self.inp_queue_vad.get()
             self.inp_queue_vad.task_done()
-            result = await self.model.infer(speech, 
-                                            self.speaker_verify, self.threshold, self.language_check, 
-                                            self.use_itn, self.add_punctuations, self.use_corrector)
-            await self.outp_queue.put(json.dumps(result, ensure_ascii = False, indent = 2))
+            try:
+                if segment["type"] == PARTIAL:
+                    await self.run_partial(segment)
+                else:
+                    await self.run_final(segment)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"[ASR] Error: {e}")
+                await self.outp_queue.put(message(ERROR, segment["utt"], segment["start"], segment["end"], 
+                                                  error = str(e)))
+
+    async def run_partial(self, segment):
+        # 已有更新的片段等待识别时丢弃过时的中间结果
+        if not self.inp_queue_vad.empty():
+            return
+        result = await self.infer_partial(segment["speech"])
+        if result is not None and result["text"]:
+            UTTERANCES.labels("partial").inc()
+            await self.outp_queue.put(message(PARTIAL, segment["utt"], segment["start"], segment["end"], result = result))
             if self.logger:
-                if result["speaker_verify_info"] is not None:
-                    self.logger.info(f"[ASR] speaker verify info: {result['speaker_verify_info']}")
-                if result["check_language"] is not None:
-                    self.logger.info(f"[ASR] check language: {result['check_language']}")
-                if result["raw_text"]:
-                    self.logger.info(f"[ASR] raw text: {result['raw_text']}")
-                if result["text"]:
-                    self.logger.info(f"[ASR] text: {result['text']}")
+                self.logger.info(f"[ASR] partial text: {result['text']}")
 
+    async def run_final(self, segment):
+        self.reset_partial()
+        result = await self.model.infer(segment["speech"], 
+                                        self.speaker_verify, self.threshold, self.language_check, 
+                                        self.use_itn, self.add_punctuations, self.use_corrector, self.speculative, 
+                                        self.fast_postprocess)
+        result["partial"] = False
+        followup = result.pop("followup", None)
+        await self.outp_queue.put(message(FINAL, segment["utt"], segment["start"], segment["end"], result = result))
+        RESULT_LATENCY.observe(time.monotonic()-segment["time"])
+        duration = len(segment["speech"])/INPUT_CHANNELS/INPUT_SAMPLE_RATE
+        if duration > 0:
+            REAL_TIME_FACTOR.observe(result["timings"]["total"]/1000/duration)
+        UTTERANCES.labels("final" if result["text"] else "empty").inc()
+        if followup is not None:
+            task = asyncio.create_task(self.send_followup(segment, followup))
+            self.followups.add(task)
+            task.add_done_callback(self.followups.discard)
+        if self.logger:
+            if result["speaker_verify_info"] is not None:
+                self.logger.info(f"[ASR] speaker verify info: {result['speaker_verify_info']}")
+            if result["check_language"] is not None:
+                self.logger.info(f"[ASR] check language: {result['check_language']}")
+            if result["raw_text"]:
+                self.logger.info(f"[ASR] raw text: {result['raw_text']}")
+            if result["text"]:
+                self.logger.info(f"[ASR] text: {result['text']}")
+            self.logger.info(f"[ASR] timings: {result['timings']}")
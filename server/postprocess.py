@@ -0,0 +1,132 @@
+import asyncio
+from collections import OrderedDict
+
+from src.executor import submit
+from src.scheduler import BatchScheduler
+
+
+class LRUCache:
+
+    def __init__(self, capacity = 4096):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self, ):
+        return len(self.data)
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.capacity:
+            self.data.popitem(last = False)
+
+
+class PunctuationBatcher(BatchScheduler):
+
+    name = "PunctuationBatcher"
+
+    def __init__(self, model, executor = None, **kwargs):
+        super().__init__(model, **kwargs)
+        self.executor = executor
+
+    def punctuate(self, texts):
+        model = self.model.get()
+        with self.model.infer_lock:
+            res = model.generate(texts)
+        return [r["text"] for r in res]
+
+    async def process(self, requests):
+        return await submit(self.executor, "pun", self.punctuate, requests)
+
+
+class CorrectorBatcher(BatchScheduler):
+
+    name = "CorrectorBatcher"
+
+    def __init__(self, model, executor = None, **kwargs):
+        super().__init__(model, **kwargs)
+        self.executor = executor
+
+    def correct(self, texts):
+        model = self.model.get()
+        with self.model.infer_lock:
+            res = model.correct_batch(texts)
+        return [(r["target"], r["errors"]) for r in res]
+
+    async def process(self, requests):
+        return await submit(self.executor, "corrector", self.correct, requests)
+
+
+class PostProcessor:
+
+    def __init__(self, pun_model, corrector, executor = None, cache_size = 4096,
+                 max_batch_size = 16, max_wait_time = 20, max_latency = 500, logger = None):
+        self.cache = LRUCache(cache_size)
+        self.pun_batcher = PunctuationBatcher(pun_model, executor = executor, logger = logger,
+                                              max_batch_size = max_batch_size, max_wait_time = max_wait_time)
+        self.cor_batcher = CorrectorBatcher(corrector, executor = executor, logger = logger,
+                                            max_batch_size = max_batch_size, max_wait_time = max_wait_time)
+        self.max_latency = max_latency    # 后处理最多增加的延迟 (ms)，超时返回未纠错文本，None 表示不限
+        self.inflight = {}
+        self.timeouts = 0
+        self.logger = logger
+
+    def key(self, text, punctuate, use_corrector):
+        return (" ".join(text.split()), punctuate, use_corrector)
+
+    async def compute(self, key):
+        text, punctuate, use_corrector = key
+        errors = None
+        try:
+            if punctuate:
+                text = await self.pun_batcher.submit(text)
+            if use_corrector:
+                text, errors = await self.cor_batcher.submit(text)
+            self.cache.put(key, (text, errors))
+            return text, errors
+        finally:
+            self.inflight.pop(key, None)
+
+    async def process(self, text, punctuate = True, use_corrector = True, capped = True):
+        # capped=False 时一直等到后处理完成（后续消息、离线转写）
+        if not text or not (punctuate or use_corrector):
+            return text, None
+        key = self.key(text, punctuate, use_corrector)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self.compute(key))
+        if not capped or self.max_latency is None:
+            return await asyncio.shield(task)
+        try:
+            # 超时后任务继续在后台完成并写入缓存
+            return await asyncio.wait_for(asyncio.shield(task), self.max_latency/1000)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if self.logger:
+                self.logger.warning(f"[PostProcessor] timeout after {self.max_latency} ms: {text}")
+            return text, None
+
+    async def run(self, ):
+        await asyncio.gather(self.pun_batcher.run(), self.cor_batcher.run())
+
+    def report(self, ):
+        return {
+            "cache_size": len(self.cache),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "timeouts": self.timeouts
+        }
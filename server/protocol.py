@@ -0,0 +1,72 @@
+import json
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+PROTOCOL_VERSION = 1
+
+# 消息类型
+VAD_START = "vad_start"
+VAD_END = "vad_end"
+PARTIAL = "partial"
+FINAL = "final"
+ERROR = "error"
+SUMMARY = "summary"
+
+
+def message(type, utt = None, start = None, end = None, **payload):
+    msg = {"type": type, "utt": utt, "start": start, "end": end}
+    msg.update(payload)
+    return msg
+
+
+class LegacyEncoder:
+
+    # protocol=0：保持原有的 "[VAD Start]" 标记和缩进 JSON 结果
+    def encode(self, msg, seq):
+        if msg["type"] == VAD_START:
+            return "[VAD Start]"
+        if msg["type"] in [PARTIAL, FINAL]:
+            return json.dumps(msg["result"], ensure_ascii = False, indent = 2)
+        return None
+
+
+class JSONEncoder:
+
+    def pack(self, msg, seq):
+        packed = {"v": PROTOCOL_VERSION, "seq": seq, "ts": int(time.time()*1000)}
+        for key, value in msg.items():
+            if key == "result":
+                packed.update(value)
+            elif value is not None:
+                packed[key] = value
+        return packed
+
+    def encode(self, msg, seq):
+        return json.dumps(self.pack(msg, seq), ensure_ascii = False, separators = (",", ":"), default = str)
+
+
+class MsgpackEncoder(JSONEncoder):
+
+    def __init__(self, ):
+        if msgpack is None:
+            raise ValueError("msgpack encoding requires msgpack")
+
+    def encode(self, msg, seq):
+        return msgpack.packb(self.pack(msg, seq), use_bin_type = True, default = str)
+
+
+def make_encoder(protocol = 0, encoding = "json"):
+    if protocol == 0:
+        return LegacyEncoder()
+    if protocol != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol: {protocol}")
+    if encoding == "json":
+        return JSONEncoder()
+    if encoding == "msgpack":
+        return MsgpackEncoder()
+    raise ValueError(f"Unsupported encoding: {encoding}")
@@ -0,0 +1,81 @@
+import time
+import asyncio
+from collections import deque
+
+
+# 队列满时的处理策略
+BLOCK = "block"                 # 阻塞写入方（输入端即为 TCP 反压）
+DROP_OLDEST = "drop_oldest"     # 丢弃最旧的条目
+MERGE = "merge"                 # 与队尾条目合并
+SKIP = "skip"                   # 丢弃可选条目（如中间结果）
+
+POLICIES = [BLOCK, DROP_OLDEST, MERGE, SKIP]
+
+
+class BoundedQueue(asyncio.Queue):
+
+    def __init__(self, maxsize = 0, policy = BLOCK, merge = None, optional = None, name = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unsupported queue policy: {policy}")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.merge = merge          # merge(old, new) -> 合并后的条目，None 表示无法合并
+        self.optional = optional    # optional(item) -> 是否可以丢弃
+        self.name = name
+        self.dropped = 0
+        self.merged = 0
+
+    def _init(self, maxsize):
+        self._queue = deque()
+
+    def _put(self, item):
+        self._queue.append((time.monotonic(), item))
+
+    def _get(self, ):
+        return self._queue.popleft()[1]
+
+    def lag(self, ):
+        if len(self._queue) == 0:
+            return 0.
+        return time.monotonic()-self._queue[0][0]
+
+    def discard(self, index):
+        del self._queue[index]
+        self.dropped += 1
+        self.task_done()
+
+    def overflow(self, item):
+        # 返回 True 表示新条目已被处理（丢弃或合并），无需再写入
+        if self.policy == DROP_OLDEST:
+            self.discard(0)
+        elif self.policy == SKIP and self.optional is not None:
+            if self.optional(item):
+                self.dropped += 1
+                return True
+            for index, (_, old) in enumerate(self._queue):
+                if self.optional(old):
+                    self.discard(index)
+                    break
+        elif self.policy == MERGE and self.merge is not None:
+            put_time, last = self._queue[-1]
+            merged = self.merge(last, item)
+            if merged is not None:
+                self._queue[-1] = (put_time, merged)
+                self.merged += 1
+                return True
+        return False
+
+    async def put(self, item):
+        if self.full() and self.policy != BLOCK and self.overflow(item):
+            return
+        await super().put(item)
+
+    def stats(self, ):
+        return {
+            "depth": self.qsize(),
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "lag_ms": round(self.lag()*1000, 1),
+            "dropped": self.dropped,
+            "merged": self.merged
+        }
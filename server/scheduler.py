@@ -0,0 +1,141 @@
+import time
+import asyncio
+
+
+class BatchScheduler:
+
+    name = "Scheduler"
+
+    def __init__(self, model, max_batch_size = 8, max_wait_time = 50, concurrency = 1, logger = None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time    # 凑批的最长等待时间 (ms)
+        self.concurrency = concurrency        # 同时处理中的批数，一般与推理线程数一致
+        self.logger = logger
+        self.pending = []
+        self.event = asyncio.Event()
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        item = (time.monotonic(), request, future)
+        self.pending.append(item)
+        self.event.set()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # 会话被取消时立即移出等待队列，不再占用合批名额和内存
+            if item in self.pending:
+                self.pending.remove(item)
+                if not self.pending:
+                    self.event.clear()
+            raise
+
+    async def process(self, requests):
+        raise NotImplementedError
+
+    async def collect(self, ):
+        # 等待中的请求可能在凑批前全部被取消，此时继续等待
+        while not self.pending:
+            self.event.clear()
+            await self.event.wait()
+        deadline = self.pending[0][0] + self.max_wait_time/1000
+        while len(self.pending) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        batch = self.pending[: self.max_batch_size]
+        self.pending = self.pending[self.max_batch_size: ]
+        if self.pending:
+            self.event.set()
+        else:
+            self.event.clear()
+        # 已断开的会话不再参与推理
+        return [item for item in batch if not item[-1].done()]
+
+    async def dispatch(self, batch):
+        try:
+            results = await self.process([request for _, request, _ in batch])
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"[{self.name}] Error: {e}")
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            # 单条请求出错时只影响该请求
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        if self.logger:
+            self.logger.debug(f"[{self.name}] batch size: {len(batch)}")
+
+    async def run(self, ):
+        # 前一批仍在处理（例如等待后处理）时继续凑下一批，最多 concurrency 批同时处理
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        try:
+            while True:
+                await semaphore.acquire()
+                batch = await self.collect()
+                if not batch:
+                    semaphore.release()
+                    continue
+                task = asyncio.create_task(self.dispatch(batch))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: semaphore.release())
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class ASRScheduler(BatchScheduler):
+
+    name = "ASRScheduler"
+
+    async def infer(self, speech,
+                    speaker_verify = None, threshold = 0.5, language_check = True,
+                    use_itn = True, add_punctuations = True, use_corrector = True, speculative = False,
+                    fast_postprocess = False):
+        option = {
+            "speaker_verify": speaker_verify,
+            "threshold": threshold,
+            "language_check": language_check,
+            "use_itn": use_itn,
+            "add_punctuations": add_punctuations,
+            "use_corrector": use_corrector,
+            "speculative": speculative,
+            "fast_postprocess": fast_postprocess
+        }
+        return await self.submit((speech, option))
+
+    async def infer_partial(self, speech, speaker_verify = None, threshold = 0.5, use_itn = True):
+        # 中间结果已按会话限频，不参与合批
+        return await self.model.infer_partial(speech, speaker_verify, threshold, use_itn)
+
+    async def process(self, requests):
+        speeches = [speech for speech, _ in requests]
+        options = [option for _, option in requests]
+        return await self.model.infer_batch(speeches, options)
+
+
+class VADScheduler(BatchScheduler):
+
+    name = "VADScheduler"
+
+    async def infer(self, chunk, chunk_size, cache, offset):
+        return await self.submit((chunk, chunk_size, cache, offset))
+
+    async def process(self, requests):
+        # 只是合并调度：一个 tick 内的所有会话在一次 executor 调用中依次推进，省去每个会话各自的线程切换与事件循环往返；
+        # 模型仍逐会话前向（各会话的流式 cache 独立），同一模型的推理也是串行的，因此不再拆给多个线程
+        return await self.model.infer_batch(requests)
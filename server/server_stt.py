@@ -5,15 +5,28 @@ logger = logging.getLogger()
 import traceback
 
 import os
+import time
 import asyncio
 import numpy as np
 
+import fire
 import uvicorn
 from urllib.parse import parse_qs
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
-from src.models import VADModel, ASRModel
-from src.pipeline import Input, VAD, ASR, Output
+from src.models import VADModel, ASRModel, load_all
+from src.backends import fork_safe
+from src.pipeline import Input, VAD, ASR, Output, PARTIAL_INTERVAL, VAD_TIME_INTERVAL, INPUT_SAMPLE_RATE, is_optional, merge_segments
+from src.queues import BoundedQueue
+from src.metrics import REGISTRY, Gauge
+from src.session import SessionManager, IDLE
+from src.scheduler import ASRScheduler, VADScheduler
+from src.executor import InferenceExecutor
+from src.codec import make_decoder, read_audio
+from src.protocol import make_encoder, message, JSONEncoder, FINAL, ERROR, SUMMARY
+from src.transcribe import Transcriber
+from src.workers import serve, worker_state
 
 
 app = FastAPI()
@@ -25,8 +38,305 @@ spk_model_path = MODEL_ROOT_PATH + "speech_campplus_sv_zh_en_16k-common_advanced
 asr_model_path = MODEL_ROOT_PATH + "SenseVoiceSmall"
 pun_model_path = MODEL_ROOT_PATH + "punc_ct-transformer_zh-cn-common-vocab272727-pytorch"
 speakers_path = "./speakers"
-vad_model = VADModel(vad_model_path)
-asr_model = ASRModel(spk_model_path, asr_model_path, pun_model_path, speakers_path)
+
+# 启动时预加载的模型，未列出的模型在首次使用时加载
+# spk: 说话人判断，asr: SenseVoice，pun: 标点模型（仅 use_itn=false 时使用），corrector: 纠错
+PRELOAD_FEATURES = ["spk", "asr"]
+WARMUP = True                # 启动时用随机音频预热各模型
+
+# 各模型的推理后端: torch (funasr, fp32) / onnx (onnxruntime, int8 量化) / onnx_fp32
+MODEL_BACKENDS = {
+    "vad": "torch", 
+    "spk": "torch", 
+    "asr": "torch", 
+    "pun": "torch"
+}
+
+VAD_WORKERS = 1              # VAD 推理线程数，VAD 模型的推理是串行的，每个 tick 一次调用
+ASR_WORKERS = 2              # 说话人/ASR/后处理推理线程数
+CODEC_WORKERS = 2            # 压缩音频解码线程数，所有会话共享
+ENROLL_WORKERS = 1           # 说话人登记线程数，与在线推理隔离
+TRANSCRIBE_WORKERS = 1       # 文件转写的解码、离线 VAD、识别与后处理线程数，与在线推理隔离
+
+VAD_MAX_BATCH_SIZE = 64      # 每个 VAD tick 最多推进的会话数
+VAD_MAX_WAIT_TIME = 10       # VAD tick 间隔 (ms)
+
+SPEAKERS_REFRESH_INTERVAL = 5    # 检查说话人存储变化的间隔 (s)
+WORKER_STATE_INTERVAL = 1        # 多 worker 部署时各 worker 发布指标与会话快照的间隔 (s)
+
+ASR_MAX_BATCH_SIZE = 8       # 跨会话合批的最大条数
+ASR_MAX_WAIT_TIME = 50       # 合批的最长等待时间 (ms)
+
+# 会话内各段队列的容量与满载策略: block / drop_oldest / merge / skip
+QUEUE_CONFIG = {
+    "input": {"maxsize": 64, "policy": "block"},     # 音频包，约 4 s，阻塞即 TCP 反压
+    "asr": {"maxsize": 4, "policy": "merge"},        # 待识别语音段，满载时合并
+    "output": {"maxsize": 256, "policy": "skip"}     # 待发送消息，满载时丢弃中间结果
+}
+
+SESSION_IDLE_TIMEOUT = 60        # 会话无收发数据超过该时间 (s) 即关闭，None 表示不限
+SESSION_LEAK_GRACE_TIME = 30     # 关闭后超过该时间 (s) 仍未被回收的会话计为泄漏
+
+POSTPROCESS_CONFIG = {
+    "cache_size": 4096,      # 标点/纠错结果的 LRU 缓存条数
+    "max_batch_size": 16,    # 标点/纠错跨会话合批的最大条数
+    "max_wait_time": 20,     # 合批的最长等待时间 (ms)
+    "max_latency": 500       # 后处理最多增加的延迟 (ms)
+}
+
+# 文件转写：离线 VAD 切分后按批并行识别
+TRANSCRIBE_CONFIG = {
+    "batch_size": 16,            # 每批识别的语音段数
+    "concurrency": TRANSCRIBE_WORKERS,   # 同时识别的批数，与转写线程数一致
+    "max_segment_time": 15000,   # 合并后语音段的最大长度 (ms)，更长的语音段会被切开
+    "merge_gap_time": 300        # 间隔不超过该值的相邻语音段合并 (ms)
+}
+
+vad_executor = InferenceExecutor(max_workers = VAD_WORKERS, name = "vad", logger = logger)
+asr_executor = InferenceExecutor(max_workers = ASR_WORKERS, name = "asr", logger = logger)
+codec_executor = InferenceExecutor(max_workers = CODEC_WORKERS, name = "codec", logger = logger)
+enroll_executor = InferenceExecutor(max_workers = ENROLL_WORKERS, name = "enroll", logger = logger)
+transcribe_executor = InferenceExecutor(max_workers = TRANSCRIBE_WORKERS, name = "transcribe", logger = logger)
+vad_model = VADModel(vad_model_path, executor = vad_executor, backend = MODEL_BACKENDS["vad"])
+asr_model = ASRModel(spk_model_path, asr_model_path, pun_model_path, speakers_path, executor = asr_executor, 
+                     postprocess_config = POSTPROCESS_CONFIG, logger = logger, backends = MODEL_BACKENDS)
+vad_scheduler = VADScheduler(vad_model, max_batch_size = VAD_MAX_BATCH_SIZE, max_wait_time = VAD_MAX_WAIT_TIME, 
+                             logger = logger)
+asr_scheduler = ASRScheduler(asr_model, max_batch_size = ASR_MAX_BATCH_SIZE, max_wait_time = ASR_MAX_WAIT_TIME, 
+                             concurrency = ASR_WORKERS, logger = logger)
+transcriber = Transcriber(vad_model, asr_model, executor = transcribe_executor, logger = logger, **TRANSCRIBE_CONFIG)
+background_tasks = []
+state = {"ready": False, "error": None}
+session_manager = SessionManager(idle_timeout = SESSION_IDLE_TIMEOUT, leak_grace_time = SESSION_LEAK_GRACE_TIME, 
+                                 logger = logger)
+
+
+def load_models(before_fork = False):
+    start_time = time.perf_counter()
+    features = PRELOAD_FEATURES
+    loaders = [vad_model.loader]
+    if before_fork:
+        # fork 前只加载可以跨进程共享的模型，其余在各 worker 启动后加载
+        features = [feature for feature in features if fork_safe(MODEL_BACKENDS.get(feature, "torch"))]
+        loaders = [loader for loader in loaders if fork_safe(MODEL_BACKENDS["vad"])]
+    load_all(loaders+[asr_model.loaders[feature] for feature in features])
+    asr_model.load(features)
+    logger.info(f"[Startup] models loaded in {time.perf_counter()-start_time:.1f} s: {features}")
+
+
+def preload_models():
+    load_models(before_fork = True)
+
+
+def prepare():
+    load_models()
+    if WARMUP:
+        start_time = time.perf_counter()
+        vad_model.warmup()
+        asr_model.warmup(PRELOAD_FEATURES)
+        logger.info(f"[Startup] models warmed up in {time.perf_counter()-start_time:.1f} s")
+
+
+async def prepare_and_ready():
+    try:
+        await asyncio.to_thread(prepare)
+    except Exception as e:
+        # 加载或预热失败：记录错误并通过 /ready 报告，负载均衡不会把流量导到这个进程
+        logger.exception(f"[Startup] prepare failed: {e}")
+        state["error"] = f"{type(e).__name__}: {e}"
+        return
+    state["ready"] = True
+
+
+async def refresh_speakers():
+    # 多进程部署时，其它 worker 登记的说话人通过存储同步过来
+    while True:
+        await asyncio.sleep(SPEAKERS_REFRESH_INTERVAL)
+        try:
+            if await enroll_executor.run("refresh", asr_model.refresh_speakers):
+                logger.info(f"[Speakers] reloaded, total {len(asr_model.reg_spks)}")
+        except Exception as e:
+            logger.error(f"[Speakers] refresh error: {e}")
+
+
+def local_state():
+    return {"metrics": REGISTRY.snapshot([("worker", worker_state().index)]), 
+            "sessions": session_manager.report()}
+
+
+async def publish_state():
+    # /metrics 与 /sessions 可能落到任一 worker，各 worker 的快照写到共享目录后汇总
+    while True:
+        try:
+            await asyncio.to_thread(worker_state().publish, local_state())
+        except Exception as e:
+            logger.error(f"[Workers] publish error: {e}")
+        await asyncio.sleep(WORKER_STATE_INTERVAL)
+
+
+@app.on_event("startup")
+async def startup():
+    if worker_state() is not None:
+        background_tasks.append(asyncio.create_task(publish_state()))
+    background_tasks.append(asyncio.create_task(prepare_and_ready()))
+    background_tasks.append(asyncio.create_task(refresh_speakers()))
+    background_tasks.append(asyncio.create_task(vad_scheduler.run()))
+    background_tasks.append(asyncio.create_task(asr_scheduler.run()))
+    background_tasks.append(asyncio.create_task(asr_model.postprocessor.run()))
+    background_tasks.append(asyncio.create_task(transcriber.postprocessor.run()))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    vad_executor.shutdown()
+    asr_executor.shutdown()
+    codec_executor.shutdown()
+    enroll_executor.shutdown()
+    transcribe_executor.shutdown()
+
+
+@app.get("/ready")
+async def ready():
+    if state["ready"]:
+        return {"ready": True}
+    return JSONResponse(status_code = 503, content = {"ready": False, "error": state["error"]})
+
+
+def queue_stats(key):
+    stats = {}
+    for session in list(session_manager.sessions.values()):
+        for name, queue in session.queues.items():
+            stats[(name, )] = max(stats.get((name, ), 0.), queue.stats()[key])
+    return stats
+
+
+REGISTRY.register(Gauge("stt_active_sessions", "Active websocket sessions", 
+                        func = lambda: {(): len(session_manager)}))
+REGISTRY.register(Gauge("stt_leaked_sessions", "Closed sessions whose stages or queues are still referenced", 
+                        func = lambda: {(): len(session_manager.leaked())}))
+REGISTRY.register(Gauge("stt_queue_depth_max", "Max queue depth over sessions", ["queue"], 
+                        func = lambda: queue_stats("depth")))
+REGISTRY.register(Gauge("stt_queue_lag_seconds_max", "Max age of the oldest queued item over sessions", ["queue"], 
+                        func = lambda: {k: v/1000 for k, v in queue_stats("lag_ms").items()}))
+
+
+@app.get("/metrics")
+async def metrics():
+    if worker_state() is None:
+        return PlainTextResponse(REGISTRY.render(), media_type = "text/plain; version=0.0.4")
+    # 多 worker 时输出所有 worker 的指标，以 worker 标签区分
+    states = await asyncio.to_thread(worker_state().collect, local_state())
+    text = REGISTRY.render_snapshots([states[index]["metrics"] for index in sorted(states)])
+    return PlainTextResponse(text, media_type = "text/plain; version=0.0.4")
+
+
+@app.get("/sessions")
+async def list_sessions():
+    if worker_state() is None:
+        return session_manager.report()
+    states = await asyncio.to_thread(worker_state().collect, local_state())
+    report = {"active": 0, "leaked": 0, "sessions": {}, "workers": {}}
+    for index, state in sorted(states.items()):
+        sessions = state["sessions"]
+        report["active"] += sessions["active"]
+        report["leaked"] += sessions["leaked"]
+        report["workers"][index] = {"active": sessions["active"], "leaked": sessions["leaked"]}
+        for session_id, stats in sessions["sessions"].items():
+            report["sessions"][session_id] = dict(stats, worker = index)
+    return report
+
+
+@app.get("/executor")
+async def executor_report():
+    return {"vad": vad_executor.report(), "asr": asr_executor.report(), 
+            "codec": codec_executor.report(), "enroll": enroll_executor.report(), 
+            "transcribe": transcribe_executor.report(), 
+            "postprocess": asr_model.postprocessor.report()}
+
+
+@app.get("/speakers")
+async def list_speakers():
+    # 首次访问会加载全部说话人向量，放到登记线程中执行
+    return {"speakers": await enroll_executor.run("list", asr_model.list_speakers)}
+
+
+async def enroll_speaker(name, request, replace):
+    audio = await request.body()
+    try:
+        total = await enroll_executor.run("enroll", asr_model.enroll_speaker, name, audio, replace)
+    except FileExistsError:
+        raise HTTPException(status_code = 409, detail = f"{name} already exists")
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    logger.info(f"[Speakers] enrolled {name}, total {total}")
+    return {"speaker": name, "total": total}
+
+
+@app.post("/speakers/{name}")
+async def create_speaker(name: str, request: Request):
+    return await enroll_speaker(name, request, replace = False)
+
+
+@app.put("/speakers/{name}")
+async def replace_speaker(name: str, request: Request):
+    return await enroll_speaker(name, request, replace = True)
+
+
+@app.delete("/speakers/{name}")
+async def delete_speaker(name: str):
+    try:
+        total = await enroll_executor.run("delete", asr_model.delete_speaker, name)
+    except KeyError:
+        raise HTTPException(status_code = 404, detail = f"{name} not found")
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    logger.info(f"[Speakers] deleted {name}, total {total}")
+    return {"speaker": name, "total": total}
+
+
+@app.post("/transcribe")
+async def transcribe(request: Request, speaker_verify: str = None, threshold: float = 0.5, 
+                     language_check: bool = True, use_itn: bool = True, add_punctuations: bool = True, 
+                     use_corrector: bool = True):
+    # 请求体为完整音频文件，逐段返回 NDJSON，每行与 protocol=1 的 final 消息格式一致
+    data = await request.body()
+    try:
+        audio = await transcribe_executor.run("decode", read_audio, data)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code = 400, detail = f"Invalid audio: {e}")
+    option = {
+        "speaker_verify": speaker_verify, 
+        "threshold": threshold, 
+        "language_check": language_check, 
+        "use_itn": use_itn, 
+        "add_punctuations": add_punctuations, 
+        "use_corrector": use_corrector
+    }
+    duration = len(audio)*1000//INPUT_SAMPLE_RATE
+    encoder = JSONEncoder()
+
+    async def stream():
+        start_time = time.perf_counter()
+        seq = 0
+        try:
+            async for k, start, end, result in transcriber.run(audio, option):
+                result["partial"] = False
+                yield encoder.encode(message(FINAL, k, start, end, result = result), seq)+"\n"
+                seq += 1
+        except Exception as e:
+            logger.error(f"[Transcribe] Error: {e}")
+            logger.error(traceback.format_exc())
+            yield encoder.encode(message(ERROR, error = str(e)), seq)+"\n"
+            return
+        elapsed = time.perf_counter()-start_time
+        logger.info(f"[Transcribe] {duration/1000:.1f} s audio, {seq} segments in {elapsed:.2f} s")
+        yield encoder.encode(message(SUMMARY, start = 0, end = duration, segments = seq, 
+                                     elapsed = round(elapsed*1000, 1), 
+                                     rtf = round(elapsed*1000/max(duration, 1), 4)), seq)+"\n"
+
+    return StreamingResponse(stream(), media_type = "application/x-ndjson")
 
 
 @app.websocket("/stt")
@@ -42,23 +352,42 @@ async def websocket_endpoint(websocket: WebSocket):
         use_itn = params.get('use_itn', ['true'])[0].lower() in ['true', '1', 't', 'y', 'yes']
         add_punctuations = params.get('add_punctuations', ['true'])[0].lower() in ['true', '1', 't', 'y', 'yes']
         use_corrector = params.get('use_corrector', ['true'])[0].lower() in ['true', '1', 't', 'y', 'yes']
+        speculative = params.get('speculative', ['false'])[0].lower() in ['true', '1', 't', 'y', 'yes']
+        fast_postprocess = params.get('fast_postprocess', ['false'])[0].lower() in ['true', '1', 't', 'y', 'yes']
+        partial = params.get('partial', ['false'])[0].lower() in ['true', '1', 't', 'y', 'yes']
+        codec = params.get('codec', ['pcm'])[0].lower()
+        sample_rate = int(params.get('sample_rate', ['16000'])[0])
+        channels = int(params.get('channels', ['1'])[0])
+        protocol = int(params.get('protocol', ['0'])[0])
+        encoding = params.get('encoding', ['json'])[0].lower()
+        try:
+            decoder = make_decoder(codec, sample_rate = sample_rate, channels = channels)
+            encoder = make_encoder(protocol, encoding)
+        except ValueError as e:
+            logger.error(f"Invalid params: {e}")
+            await websocket.close(code = 1003)
+            return
+        partial_interval = max(int(params.get('partial_interval', [str(PARTIAL_INTERVAL)])[0]), VAD_TIME_INTERVAL)
         await websocket.accept()
         
-        inp_queue = asyncio.Queue()
-        outp_queue = asyncio.Queue()
-        queue_from_vad_to_asr = asyncio.Queue()
-
-        inp = Input(websocket, inp_queue)
-        outp = Output(websocket, outp_queue)
-        vad = VAD(vad_model, inp_queue, queue_from_vad_to_asr, logger = logger)
-        asr = ASR(asr_model, queue_from_vad_to_asr, outp_queue, logger = logger, 
-                  speaker_verify = speaker_verify, threshold = threshold, language_check = language_check, 
-                  use_itn = use_itn, add_punctuations = add_punctuations, use_corrector = use_corrector)
-        await asyncio.gather(inp.run(), outp.run(), vad.run(), asr.run())
+        inp_queue = BoundedQueue(**QUEUE_CONFIG["input"], optional = is_optional, name = "input")
+        outp_queue = BoundedQueue(**QUEUE_CONFIG["output"], optional = is_optional, name = "output")
+        queue_from_vad_to_asr = BoundedQueue(**QUEUE_CONFIG["asr"], merge = merge_segments, optional = is_optional, name = "asr")
 
-        queues = [inp_queue, outp_queue, queue_from_vad_to_asr]
-        for queue in queues:
-            await queue.join()
+        inp = Input(websocket, inp_queue, decoder = decoder, executor = codec_executor)
+        outp = Output(websocket, outp_queue, encoder = encoder)
+        vad = VAD(vad_scheduler, inp_queue, queue_from_vad_to_asr, outp_queue, logger = logger, 
+                  partial = partial, partial_interval = partial_interval)
+        asr = ASR(asr_scheduler, queue_from_vad_to_asr, outp_queue, logger = logger, 
+                  speaker_verify = speaker_verify, threshold = threshold, language_check = language_check, 
+                  use_itn = use_itn, add_punctuations = add_punctuations, use_corrector = use_corrector, 
+                  speculative = speculative, fast_postprocess = fast_postprocess)
+        session = session_manager.open({"input": inp_queue, "asr": queue_from_vad_to_asr, "output": outp_queue})
+        # 任一阶段结束（通常是客户端断开）或空闲超时，其余阶段立即取消
+        reason = await session.run({"input": inp, "output": outp, "vad": vad, "asr": asr})
+        if reason == IDLE:
+            logger.info(f"Session {session.id} idle for {SESSION_IDLE_TIMEOUT} s, closing")
+            await websocket.close(code = 1000)
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     except Exception as e:
@@ -70,6 +399,14 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.info("Cleaned up resources after WebSocket disconnect")
 
 
+def main(host = "0.0.0.0", port = 7016, workers = 1, threads = None):
+    if workers > 1:
+        # 父进程只加载模型不做推理，预热在各 worker 启动后进行
+        serve(app, host, port, workers = workers, threads = threads, preload = preload_models)
+    else:
+        uvicorn.run(app, host = host, port = port)
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host = "0.0.0.0", port = 7016)
+    fire.Fire(main)
 
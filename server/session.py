@@ -0,0 +1,123 @@
+import time
+import uuid
+import weakref
+import asyncio
+
+from src.metrics import SESSIONS_CLOSED
+
+
+IDLE = "idle"
+
+
+class Session:
+
+    def __init__(self, manager, queues, idle_timeout = None):
+        self.manager = manager
+        self.id = uuid.uuid4().hex
+        self.queues = queues        # {name: BoundedQueue}
+        self.idle_timeout = idle_timeout
+        self.stages = {}
+        self.tasks = {}
+        self.created = time.monotonic()
+        self.closed = None          # 关闭时间
+        self.reason = None          # 关闭原因：idle、结束的阶段名或异常类型
+
+    def last_active(self, ):
+        # 各阶段在收发数据时更新 last_active
+        return max([self.created]+[getattr(stage, "last_active", self.created) for stage in self.stages.values()])
+
+    def idle_time(self, ):
+        return time.monotonic()-self.last_active()
+
+    async def run(self, stages):
+        # 任一阶段结束或出错、或空闲超时，立即取消其余阶段并回收资源
+        self.stages = stages
+        self.tasks = {name: asyncio.create_task(stage.run(), name = f"{self.id[: 8]}-{name}")
+                      for name, stage in stages.items()}
+        try:
+            while True:
+                timeout = None
+                if self.idle_timeout:
+                    timeout = max(self.idle_timeout-self.idle_time(), 0)
+                done, _ = await asyncio.wait(self.tasks.values(), timeout = timeout,
+                                             return_when = asyncio.FIRST_COMPLETED)
+                if done:
+                    name, task = next((name, task) for name, task in self.tasks.items() if task in done)
+                    if not task.cancelled() and task.exception() is not None:
+                        self.reason = type(task.exception()).__name__
+                        raise task.exception()
+                    self.reason = name
+                    return self.reason
+                if self.idle_time() >= self.idle_timeout:
+                    self.reason = IDLE
+                    return self.reason
+        finally:
+            await self.close()
+
+    async def close(self, ):
+        if self.closed is not None:
+            return
+        self.closed = time.monotonic()
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions = True)
+        for stage in self.stages.values():
+            if hasattr(stage, "release"):
+                stage.release()
+        for queue in self.queues.values():
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+        self.manager.remove(self)
+        self.tasks = {}
+        self.stages = {}
+        self.queues = {}
+
+    def stats(self, ):
+        now = time.monotonic()
+        return {
+            "age_s": round(now-self.created, 1),
+            "idle_s": round(now-self.last_active(), 1),
+            "queues": {name: queue.stats() for name, queue in self.queues.items()},
+            "buffered_samples": {name: len(stage.buffer) for name, stage in self.stages.items()
+                                 if getattr(stage, "buffer", None) is not None}
+        }
+
+
+class SessionManager:
+
+    def __init__(self, idle_timeout = 60, leak_grace_time = 30, logger = None):
+        self.idle_timeout = idle_timeout            # 无收发数据的最长时间 (s)，None 表示不限
+        self.leak_grace_time = leak_grace_time      # 关闭后超过该时间仍未被回收的会话计为泄漏 (s)
+        self.logger = logger
+        self.sessions = {}
+        self.closed = weakref.WeakKeyDictionary()   # 已关闭会话的各个对象 -> (会话 id, 关闭时间)
+
+    def __len__(self, ):
+        return len(self.sessions)
+
+    def open(self, queues):
+        session = Session(self, queues, idle_timeout = self.idle_timeout)
+        self.sessions[session.id] = session
+        return session
+
+    def remove(self, session):
+        self.sessions.pop(session.id, None)
+        for obj in [session]+list(session.stages.values())+list(session.queues.values()):
+            self.closed[obj] = (session.id, session.closed)
+        SESSIONS_CLOSED.labels(session.reason or "cancelled").inc()
+        if self.logger:
+            self.logger.info(f"[Session] {session.id} closed ({session.reason or 'cancelled'}) "
+                             f"after {session.closed-session.created:.1f} s, live {len(self.sessions)}")
+
+    def leaked(self, ):
+        # 已关闭但仍有对象（阶段、队列）未被回收的会话
+        now = time.monotonic()
+        return {session_id for session_id, closed in list(self.closed.values()) if now-closed > self.leak_grace_time}
+
+    def report(self, ):
+        return {
+            "active": len(self.sessions),
+            "leaked": len(self.leaked()),
+            "sessions": {session_id: session.stats() for session_id, session in list(self.sessions.items())}
+        }
@@ -0,0 +1,219 @@
+import os
+import io
+import json
+import fcntl
+import bisect
+import hashlib
+import threading
+import contextlib
+
+import torch
+import soundfile
+import numpy as np
+
+
+class SpeakerIndex:
+
+    def __init__(self, names, embeddings):
+        order = sorted(range(len(names)), key = names.__getitem__)
+        self.names = [names[k] for k in order] # 有序存储，前缀匹配的结果是一个连续区间
+        if len(order) > 0:
+            embeddings = torch.nn.functional.normalize(embeddings[order].float(), dim = -1)
+            self.embeddings = embeddings.contiguous()
+        else:
+            self.embeddings = torch.zeros((0, 0))
+
+    def __len__(self, ):
+        return len(self.names)
+
+    def __iter__(self, ):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        k = bisect.bisect_left(self.names, name)
+        return k < len(self.names) and self.names[k] == name
+
+    def search(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix+chr(0x10ffff), lo = lo)
+        return lo, hi
+
+    def score(self, source, lo, hi):
+        source = torch.nn.functional.normalize(source.flatten().float(), dim = -1)
+        return (1.+self.embeddings[lo: hi]@source)/2
+
+
+class SpeakerStore:
+
+    # 登记信息（名字、embedding 与清单）按名字有序，整体存放在一个文件中，用 os.replace 原子替换，
+    # 其它进程总是读到一个完整的版本；跨进程的修改由文件锁串行，刷新只读不写
+    def __init__(self, speakers_path, embed, sample_rate = 16000):
+        self.speakers_path = speakers_path
+        self.cache_path = os.path.join(speakers_path, ".cache")
+        self.store_path = os.path.join(self.cache_path, "speakers.npz")
+        self.lock_path = os.path.join(self.cache_path, "speakers.lock")
+        self.embed = embed
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.manifest = {}
+        self.version = None # 当前内容对应的存储文件 (inode, mtime)
+        self.names = []
+        self.embeddings = np.zeros((0, 0), dtype = np.float32)
+
+    @contextlib.contextmanager
+    def file_lock(self, ):
+        os.makedirs(self.cache_path, exist_ok = True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def file_path(self, name):
+        if not name or name.startswith(".") or os.path.basename(name) != name:
+            raise ValueError(f"Invalid speaker name: {name}")
+        return os.path.join(self.speakers_path, name+".wav")
+
+    def digest(self, file_path):
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def embed_file(self, file_path):
+        data, sample_rate = soundfile.read(file_path, dtype = "float32")
+        return np.asarray(self.embed(data), dtype = np.float32).flatten()
+
+    def read(self, ):
+        # 返回 (names, embeddings, manifest, version)，存储文件不存在时返回 None
+        try:
+            f = open(self.store_path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            stat = os.fstat(f.fileno())
+            with np.load(f, allow_pickle = False) as data:
+                names = [str(name) for name in data["names"]]
+                embeddings = np.array(data["embeddings"], dtype = np.float32)
+                manifest = json.loads(data["manifest"].item())
+        return names, embeddings, manifest, (stat.st_ino, stat.st_mtime_ns)
+
+    def write(self, ):
+        os.makedirs(self.cache_path, exist_ok = True)
+        tmp_path = f"{self.store_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, names = np.array(self.names, dtype = str), embeddings = self.embeddings, 
+                     manifest = np.array(json.dumps(self.manifest, ensure_ascii = False)))
+        os.replace(tmp_path, self.store_path)
+        stat = os.stat(self.store_path)
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+
+    def sync(self, ):
+        # 存储文件变化时读入其它进程写入的内容，返回是否有变化
+        try:
+            stat = os.stat(self.store_path)
+        except FileNotFoundError:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns) == self.version:
+            return False
+        stored = self.read()
+        if stored is None:
+            return False
+        self.names, self.embeddings, self.manifest, self.version = stored
+        return True
+
+    def load(self, ):
+        # 按目录中的 wav 文件重建登记信息，未变化的文件复用已存储的 embedding
+        with self.lock, self.file_lock():
+            stored = self.read()
+            cached, manifest = {}, {}
+            if stored is not None:
+                names, embeddings, manifest, _ = stored
+                cached = dict(zip(names, embeddings))
+            files = {}
+            for file in os.listdir(self.speakers_path):
+                file_path = os.path.join(self.speakers_path, file)
+                spk, base = os.path.splitext(os.path.basename(file))
+                if os.path.isfile(file_path) and base in [".wav"]:
+                    files[spk] = file_path
+            names, rows, entries = [], [], {}
+            for spk in sorted(files):
+                file_path = files[spk]
+                stat = os.stat(file_path)
+                entry = manifest.get(spk)
+                # 大小和修改时间未变时跳过哈希，哈希未变时复用已有的 embedding
+                if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                    sha1 = entry["sha1"]
+                else:
+                    sha1 = self.digest(file_path)
+                if entry and entry["sha1"] == sha1 and spk in cached:
+                    rows.append(cached[spk])
+                else:
+                    rows.append(self.embed_file(file_path))
+                entries[spk] = {"sha1": sha1, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+                names.append(spk)
+            self.names = names
+            self.embeddings = np.stack(rows) if rows else np.zeros((0, 0), dtype = np.float32)
+            self.manifest = entries
+            if stored is None or entries != manifest or names != stored[0]:
+                self.write()
+            else:
+                self.version = stored[3]
+            return self.index()
+
+    def refresh(self, ):
+        # 其它进程修改登记信息后重新读取（不写入存储），未变化时返回 None
+        with self.lock:
+            if not self.sync():
+                return None
+            return self.index()
+
+    def index(self, ):
+        if len(self.names) == 0:
+            return SpeakerIndex([], None)
+        return SpeakerIndex(list(self.names), torch.from_numpy(self.embeddings))
+
+    def enroll(self, name, audio):
+        file_path = self.file_path(name)
+        data, sample_rate = soundfile.read(io.BytesIO(audio), dtype = "float32")
+        if sample_rate != self.sample_rate:
+            raise ValueError(f"Sample rate must be {self.sample_rate}, got {sample_rate}")
+        if data.ndim > 1:
+            data = data.mean(axis = 1)
+        embedding = np.asarray(self.embed(data), dtype = np.float32).flatten()
+        with self.lock, self.file_lock():
+            self.sync() # 先合并其它进程的修改，避免覆盖
+            tmp_path = f"{file_path}.{os.getpid()}.tmp"
+            soundfile.write(tmp_path, data, sample_rate, format = "WAV")
+            os.replace(tmp_path, file_path)
+            stat = os.stat(file_path)
+            entry = {"sha1": self.digest(file_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+            if name in self.manifest:
+                self.embeddings[self.names.index(name)] = embedding
+            else:
+                row = bisect.bisect_left(self.names, name) # 保持有序
+                self.names.insert(row, name)
+                if len(self.embeddings) == 0:
+                    self.embeddings = embedding[None]
+                else:
+                    self.embeddings = np.insert(self.embeddings, row, embedding, axis = 0)
+            self.manifest[name] = entry
+            self.write()
+            return self.index()
+
+    def delete(self, name):
+        file_path = self.file_path(name)
+        with self.lock, self.file_lock():
+            self.sync()
+            if name not in self.manifest:
+                raise KeyError(name)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+            row = self.names.index(name)
+            self.names.pop(row)
+            self.manifest.pop(name)
+            self.embeddings = np.delete(self.embeddings, row, axis = 0)
+            self.write()
+            return self.index()
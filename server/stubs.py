@@ -0,0 +1,112 @@
+import time
+import numpy as np
+import torch
+
+
+# 替代 funasr/pycorrector 模型的桩实现，用于单独测量编排开销
+# 接口与 AutoModel.generate / Corrector.correct 的返回格式保持一致
+
+
+class StubVAD:
+
+    def __init__(self, threshold = 0.01, max_end_silence_time = 200, frame_time = 10, sample_rate = 16000, cost = 0.):
+        self.threshold = threshold
+        self.max_end_silence_time = max_end_silence_time
+        self.frame_time = frame_time
+        self.frame_size = sample_rate*frame_time//1000
+        self.sample_rate = sample_rate
+        self.cost = cost    # 每次调用的模拟耗时 (s)
+
+    def generate(self, input, chunk_size = None, cache = None, is_final = True):
+        if cache is None:
+            # 离线模式：整段音频一次检测，返回完整的 [start, end] 对
+            chunk_size = len(input)*1000//self.sample_rate
+            segments = self.generate(input, chunk_size, {}, is_final = False)[0]["value"]
+            pairs = []
+            for start, end in segments:
+                if start >= 0:
+                    pairs.append([start, -1])
+                if end >= 0:
+                    pairs[-1][1] = end
+            if pairs and pairs[-1][1] < 0:
+                pairs[-1][1] = chunk_size
+            return [{"value": pairs}]
+        if self.cost:
+            time.sleep(self.cost)
+        samples = np.asarray(input, dtype = np.float32)
+        count = len(samples)//self.frame_size
+        frames = samples[: count*self.frame_size].reshape(count, self.frame_size)
+        energies = np.sqrt(np.mean(frames**2, axis = 1))
+        offset = cache.get("offset", 0)
+        in_speech = cache.get("in_speech", False)
+        silence = cache.get("silence", 0)
+        last_voice = cache.get("last_voice", 0)
+        segments = []
+        for k, energy in enumerate(energies):
+            t = offset+k*self.frame_time
+            if energy >= self.threshold:
+                if not in_speech:
+                    in_speech = True
+                    segments.append([t, -1])
+                silence = 0
+                last_voice = t+self.frame_time
+            elif in_speech:
+                silence += self.frame_time
+                if silence >= self.max_end_silence_time:
+                    in_speech = False
+                    segments.append([-1, last_voice])
+        cache.update({"offset": offset+chunk_size, "in_speech": in_speech, "silence": silence, "last_voice": last_voice})
+        return [{"value": segments}]
+
+
+class StubSpeaker:
+
+    def __init__(self, dim = 192, cost = 0.01):
+        self.dim = dim
+        self.cost = cost
+
+    def generate(self, data):
+        if self.cost:
+            time.sleep(self.cost)
+        generator = torch.Generator().manual_seed(len(data))
+        return [{"spk_embedding": torch.randn((1, self.dim), generator = generator)}]
+
+
+class StubASR:
+
+    def __init__(self, rtf = 0.02, overhead = 0.01, text = "测试文本", sample_rate = 16000):
+        self.rtf = rtf              # 每秒音频的模拟耗时 (s)
+        self.overhead = overhead    # 每次调用的固定耗时 (s)
+        self.text = text
+        self.sample_rate = sample_rate
+
+    def generate(self, speeches, use_itn = True, batch_size = 1, **kwargs):
+        seconds = sum(len(speech) for speech in speeches)/self.sample_rate
+        time.sleep(self.overhead+seconds*self.rtf)
+        tag = "<|withitn|>" if use_itn else "<|woitn|>"
+        return [{"text": f"<|zh|><|NEUTRAL|><|Speech|>{tag}{self.text}"} for _ in speeches]
+
+
+class StubPunctuation:
+
+    def __init__(self, cost = 0.005):
+        self.cost = cost
+
+    def generate(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+        time.sleep(self.cost*len(texts))
+        return [{"text": text+"。"} for text in texts]
+
+
+class StubCorrector:
+
+    def __init__(self, cost = 0.005):
+        self.cost = cost
+
+    def correct(self, text):
+        return self.correct_batch([text])[0]
+
+    def correct_batch(self, texts):
+        time.sleep(self.cost*len(texts))
+        return [{"target": text, "errors": []} for text in texts]
@@ -0,0 +1,12 @@
+import os
+import sys
+import types
+
+
+# 服务端模块部署时位于 src 包下（server_stt.py 中为 from src.xxx import ...），测试时将本目录映射为 src
+SERVER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "src" not in sys.modules:
+    src = types.ModuleType("src")
+    src.__path__ = [SERVER_PATH]
+    sys.modules["src"] = src
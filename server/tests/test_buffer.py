@@ -0,0 +1,58 @@
+import numpy as np
+
+from src.buffer import AudioBuffer
+
+
+def pcm(values):
+    return np.asarray(values, dtype = np.int16).tobytes()
+
+
+def test_overflow_drops_oldest_samples():
+    buffer = AudioBuffer(10)
+    buffer.write(pcm(range(1, 9)))
+    buffer.write(pcm(range(9, 14)))
+    assert buffer.dropped == 3
+    assert (buffer.start, buffer.end) == (3, 13)
+    np.testing.assert_array_equal(buffer.view(buffer.start, buffer.end)*32768, np.arange(4, 14))
+
+
+def test_write_larger_than_capacity_keeps_latest():
+    buffer = AudioBuffer(10)
+    buffer.write(pcm(range(1, 5)))
+    buffer.write(pcm(range(5, 17)))
+    assert buffer.dropped == 6
+    assert (buffer.start, buffer.end) == (6, 16)
+    np.testing.assert_array_equal(buffer.view(buffer.start, buffer.end)*32768, np.arange(7, 17))
+
+
+def test_evicted_space_is_reused_without_dropping():
+    buffer = AudioBuffer(10)
+    buffer.write(pcm(range(1, 9)))
+    buffer.evict(6)
+    buffer.write(pcm(range(9, 14)))
+    assert buffer.dropped == 0
+    np.testing.assert_array_equal(buffer.view(6, 13)*32768, np.arange(7, 14))
+
+
+def test_grows_on_demand_up_to_capacity():
+    buffer = AudioBuffer(16, 4)
+    buffer.write(pcm(range(1, 4)))
+    assert len(buffer.data) == 4
+    buffer.write(pcm(range(4, 10)))
+    assert buffer.dropped == 0
+    assert len(buffer.data) == 9
+    buffer.write(pcm(range(10, 21)))
+    assert len(buffer.data) == 16
+    assert buffer.dropped == 4
+    np.testing.assert_array_equal(buffer.view(buffer.start, buffer.end)*32768, np.arange(5, 21))
+
+
+def test_shrinks_after_eviction():
+    buffer = AudioBuffer(16, 4)
+    buffer.write(pcm(range(1, 17)))
+    buffer.evict(14)
+    assert len(buffer.data) == 4
+    np.testing.assert_array_equal(buffer.view(buffer.start, buffer.end)*32768, np.arange(15, 17))
+    buffer.write(pcm(range(17, 20)))
+    assert buffer.dropped == 0
+    np.testing.assert_array_equal(buffer.view(14, 19)*32768, np.arange(15, 20))
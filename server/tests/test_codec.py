@@ -0,0 +1,40 @@
+import numpy as np
+
+from src.codec import StreamingResampler, resample
+
+
+def tone(freq, rate, seconds = 1.):
+    return np.sin(2*np.pi*freq*np.arange(int(rate*seconds))/rate).astype(np.float32)
+
+
+def rms(samples):
+    # 去掉首尾的滤波器过渡段
+    samples = samples[len(samples)//10: -len(samples)//10]
+    return float(np.sqrt(np.mean(samples**2)))
+
+
+def test_downsample_keeps_speech_band():
+    for rate in [48000, 44100, 22050]:
+        output = resample(tone(1000, rate), rate)
+        assert abs(len(output)-16000) <= 1
+        assert abs(rms(output)-rms(tone(1000, 16000))) < 0.01
+
+
+def test_downsample_rejects_aliases():
+    # 12 kHz 在 16k 采样下会折叠到 4 kHz
+    for rate in [48000, 44100]:
+        assert rms(resample(tone(12000, rate), rate)) < 0.01
+
+
+def test_upsample():
+    output = resample(tone(1000, 8000), 8000)
+    assert len(output) == 16000
+    np.testing.assert_allclose(output[1000: -1000], tone(1000, 16000)[1000: -1000], atol = 0.01)
+
+
+def test_streaming_matches_whole_file():
+    samples = np.random.default_rng(0).standard_normal(44100).astype(np.float32)
+    resampler = StreamingResampler(44100)
+    chunks = [resampler.process(chunk) for chunk in np.array_split(samples, 37)]
+    streamed = np.concatenate(chunks+[resampler.flush()])
+    np.testing.assert_allclose(streamed, resample(samples, 44100), atol = 1e-5)
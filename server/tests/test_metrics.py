@@ -0,0 +1,41 @@
+import pytest
+
+from src.metrics import Registry, Counter, Gauge, Histogram
+
+
+def make_registry():
+    registry = Registry()
+    counter = registry.register(Counter("test_requests", "Requests", ["type"]))
+    gauge = registry.register(Gauge("test_active", "Active", func = lambda: {(): 2}))
+    histogram = registry.register(Histogram("test_seconds", "Seconds", buckets = (.1, 1.)))
+    return registry, counter, gauge, histogram
+
+
+def test_render():
+    registry, counter, gauge, histogram = make_registry()
+    counter.labels("final").inc(3)
+    histogram.observe(.5)
+    lines = registry.render().splitlines()
+    assert 'test_requests_total{type="final"} 3.0' in lines
+    assert "test_active 2" in lines
+    assert 'test_seconds_bucket{le="0.1"} 0' in lines
+    assert 'test_seconds_bucket{le="1.0"} 1' in lines
+    assert "test_seconds_count 1" in lines
+
+
+def test_workers_merged_under_one_header(tmp_path):
+    WorkerState = pytest.importorskip("src.workers").WorkerState
+    snapshots = {}
+    for index in range(2):
+        registry, counter, gauge, histogram = make_registry()
+        counter.labels("final").inc(index+1)
+        state = WorkerState(str(tmp_path), index, 2)
+        state.publish({"metrics": registry.snapshot([("worker", index)])})
+        snapshots[index] = state
+    states = snapshots[0].collect({"metrics": {}})
+    assert sorted(states) == [0, 1]
+    registry = make_registry()[0]
+    lines = registry.render_snapshots([states[0]["metrics"], states[1]["metrics"]]).splitlines()
+    assert lines.count("# TYPE test_requests counter") == 1
+    assert 'test_requests_total{worker="1",type="final"} 2.0' in lines
+    assert not any('worker="0"' in line for line in lines)
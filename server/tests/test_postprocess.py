@@ -0,0 +1,57 @@
+import time
+import asyncio
+import threading
+
+from src.executor import InferenceExecutor
+from src.postprocess import PostProcessor
+
+
+class Loaded:
+
+    def __init__(self, value):
+        self.value = value
+        self.infer_lock = threading.Lock()
+
+    def get(self, ):
+        return self.value
+
+
+class SlowPunctuation:
+
+    def generate(self, texts):
+        time.sleep(0.1)
+        return [{"text": text+"。"} for text in texts]
+
+
+def run_process(capped, max_latency = 20):
+
+    async def main():
+        executor = InferenceExecutor(max_workers = 1, name = "test")
+        postprocessor = PostProcessor(Loaded(SlowPunctuation()), Loaded(None), executor = executor, 
+                                      max_wait_time = 0, max_latency = max_latency)
+        runner = asyncio.create_task(postprocessor.run())
+        try:
+            return await postprocessor.process("你好", punctuate = True, use_corrector = False, capped = capped), postprocessor
+        finally:
+            runner.cancel()
+            executor.shutdown()
+
+    return asyncio.run(main())
+
+
+def test_capped_returns_raw_text_on_timeout():
+    (text, errors), postprocessor = run_process(capped = True)
+    assert text == "你好"
+    assert postprocessor.timeouts == 1
+
+
+def test_uncapped_waits_for_result():
+    (text, errors), postprocessor = run_process(capped = False)
+    assert text == "你好。"
+    assert postprocessor.timeouts == 0
+
+
+def test_unlimited_postprocessor_waits_for_result():
+    (text, errors), postprocessor = run_process(capped = True, max_latency = None)
+    assert text == "你好。"
+    assert postprocessor.timeouts == 0
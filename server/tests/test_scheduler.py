@@ -0,0 +1,105 @@
+import asyncio
+
+from src.scheduler import BatchScheduler, VADScheduler
+
+
+class EchoScheduler(BatchScheduler):
+
+    def __init__(self, *args, delay = 0.05, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.batches = []
+
+    async def process(self, requests):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        self.batches.append(list(requests))
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return requests
+
+
+def test_concurrent_batches():
+
+    async def main():
+        scheduler = EchoScheduler(max_batch_size = 1, max_wait_time = 0, concurrency = 2)
+        runner = asyncio.create_task(scheduler.run())
+        results = await asyncio.gather(*(scheduler.submit(k) for k in range(4)))
+        runner.cancel()
+        return scheduler, results
+
+    scheduler, results = asyncio.run(main())
+    assert results == [0, 1, 2, 3]
+    assert scheduler.peak == 2
+
+
+class RecordingModel:
+
+    def __init__(self, ):
+        self.calls = []
+
+    async def infer_batch(self, requests):
+        self.calls.append(list(requests))
+        await asyncio.sleep(0)
+        return [request*10 for request in requests]
+
+
+def test_vad_batch_dispatched_once():
+
+    async def main():
+        model = RecordingModel()
+        scheduler = VADScheduler(model, max_batch_size = 64, max_wait_time = 0)
+        return model, await scheduler.process(list(range(5)))
+
+    model, results = asyncio.run(main())
+    assert results == [0, 10, 20, 30, 40]
+    assert model.calls == [[0, 1, 2, 3, 4]]
+
+
+def test_cancelled_request_does_not_break_scheduler():
+
+    async def main():
+        scheduler = EchoScheduler(max_batch_size = 1, max_wait_time = 0, delay = 0.05)
+        runner = asyncio.create_task(scheduler.run())
+        first = asyncio.create_task(scheduler.submit(1))
+        await asyncio.sleep(0.01) # 第一批正在处理
+        second = asyncio.create_task(scheduler.submit(2))
+        await asyncio.sleep(0)
+        second.cancel() # 客户端断开
+        assert await first == 1
+        try:
+            result = await asyncio.wait_for(scheduler.submit(3), 1)
+        finally:
+            alive = not runner.done()
+            runner.cancel()
+        return result, alive, scheduler.batches
+
+    result, alive, batches = asyncio.run(main())
+    assert alive
+    assert result == 3
+    assert batches == [[1], [3]]
+
+
+class FailingScheduler(BatchScheduler):
+
+    async def process(self, requests):
+        return [ValueError(request) if request < 0 else request for request in requests]
+
+
+def test_failed_request_does_not_fail_batch():
+
+    async def main():
+        scheduler = FailingScheduler(None, max_batch_size = 4, max_wait_time = 10)
+        runner = asyncio.create_task(scheduler.run())
+        tasks = [asyncio.create_task(scheduler.submit(k)) for k in [1, -1, 2]]
+        await asyncio.wait(tasks)
+        runner.cancel()
+        return tasks
+
+    tasks = asyncio.run(main())
+    assert tasks[0].result() == 1 and tasks[2].result() == 2
+    assert isinstance(tasks[1].exception(), ValueError)
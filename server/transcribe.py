@@ -0,0 +1,86 @@
+import time
+import asyncio
+
+from src.pipeline import INPUT_SAMPLE_RATE
+from src.postprocess import PostProcessor
+
+
+def ms_to_samples(ms):
+    return ms*INPUT_SAMPLE_RATE//1000
+
+
+def plan_segments(segments, max_segment_time = 15000, merge_gap_time = 300):
+    # 相邻且间隔很短的语音段合并，减少识别调用次数；超长的语音段等分切开
+    planned = []
+    for start, end in segments:
+        if planned and start-planned[-1][1] <= merge_gap_time and end-planned[-1][0] <= max_segment_time:
+            planned[-1] = (planned[-1][0], end)
+        else:
+            planned.append((start, end))
+    result = []
+    for start, end in planned:
+        count = -(-(end-start)//max_segment_time)
+        for k in range(count):
+            result.append((start+(end-start)*k//count, start+(end-start)*(k+1)//count))
+    return result
+
+
+class Transcriber:
+
+    def __init__(self, vad_model, asr_model, executor = None, batch_size = 16, concurrency = 2,
+                 max_segment_time = 15000, merge_gap_time = 300, logger = None):
+        self.vad_model = vad_model
+        self.asr_model = asr_model
+        self.executor = executor    # 离线 VAD、识别与后处理使用的线程池，与实时会话隔离
+        # 独立的标点/纠错合批，不限延迟：离线结果总是等待后处理完成
+        self.postprocessor = PostProcessor(asr_model.loaders["pun"], asr_model.loaders["corrector"], executor = executor, 
+                                           max_batch_size = batch_size, max_latency = None, logger = logger)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_segment_time = max_segment_time
+        self.merge_gap_time = merge_gap_time
+        self.logger = logger
+
+    async def segment(self, audio):
+        start_time = time.perf_counter()
+        segments = await self.vad_model.infer_offline(audio, executor = self.executor)
+        segments = plan_segments(segments, self.max_segment_time, self.merge_gap_time)
+        if self.logger:
+            self.logger.info(f"[Transcriber] {len(audio)/INPUT_SAMPLE_RATE:.1f} s audio, {len(segments)} segments, "
+                             f"vad {time.perf_counter()-start_time:.2f} s")
+        return segments
+
+    def batches(self, segments):
+        # 每个窗口内按长度排序后分批，减少批内补齐；窗口之间保持原顺序，便于按顺序输出
+        window = self.batch_size*self.concurrency
+        batches = []
+        for w in range(0, len(segments), window):
+            ks = sorted(range(w, min(w+window, len(segments))), key = lambda k: segments[k][1]-segments[k][0])
+            batches.extend(ks[i: i+self.batch_size] for i in range(0, len(ks), self.batch_size))
+        return batches
+
+    async def decode(self, audio, segments, ks, option, semaphore):
+        async with semaphore:
+            speeches = [audio[ms_to_samples(segments[k][0]): ms_to_samples(segments[k][1])] for k in ks]
+            results = await self.asr_model.infer_batch(speeches, [option]*len(ks), 
+                                                        executor = self.executor, postprocessor = self.postprocessor)
+        return dict(zip(ks, results))
+
+    async def run(self, audio, option):
+        # 逐段产出 (序号, 开始 ms, 结束 ms, 识别结果)，多个批次并行识别，按时间顺序输出
+        segments = await self.segment(audio)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.ensure_future(self.decode(audio, segments, ks, option, semaphore))
+                 for ks in self.batches(segments)]
+        try:
+            results = {}
+            k = 0
+            for task in tasks:
+                results.update(await task)
+                while k in results:
+                    yield k, segments[k][0], segments[k][1], results.pop(k)
+                    k += 1
+        finally:
+            # 客户端断开时取消尚未完成的批次
+            for task in tasks:
+                task.cancel()
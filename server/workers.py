@@ -0,0 +1,116 @@
+import gc
+import os
+import json
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import multiprocessing
+
+import torch
+import uvicorn
+
+
+logger = logging.getLogger()
+
+current = None      # 多进程部署时本进程的 WorkerState，单进程时为 None
+
+
+class WorkerState:
+
+    # 每个请求只会落到一个 worker，各 worker 定期把指标与会话快照写到共享目录，查询时汇总所有 worker
+
+    def __init__(self, path, index, workers):
+        self.path = path
+        self.index = index
+        self.workers = workers
+
+    def file_path(self, index):
+        return os.path.join(self.path, f"worker-{index}.json")
+
+    def publish(self, state):
+        tmp_path = self.file_path(self.index)+".tmp"
+        with open(tmp_path, "w", encoding = "utf-8") as f:
+            json.dump(state, f, ensure_ascii = False)
+        os.replace(tmp_path, self.file_path(self.index))
+
+    def collect(self, state):
+        # state 为本进程的最新快照，其它 worker 的快照最多滞后一个发布周期
+        states = {}
+        for index in range(self.workers):
+            if index == self.index:
+                states[index] = state
+                continue
+            try:
+                with open(self.file_path(index), "r", encoding = "utf-8") as f:
+                    states[index] = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+        return states
+
+
+def worker_state():
+    return current
+
+
+def split_threads(workers, threads = None):
+    # 未指定时按核数平均分配给各个 worker，避免多个进程争抢同一批核
+    if threads:
+        return threads
+    return max((os.cpu_count() or 1)//workers, 1)
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, threads, index, workers, state_path):
+    global current
+    current = WorkerState(state_path, index, workers)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    logger.info(f"[Worker {index}] pid {os.getpid()}, torch threads {threads}")
+    config = uvicorn.Config(app, lifespan = "on")
+    server = uvicorn.Server(config)
+    server.run(sockets = [sock])
+
+
+def serve(app, host, port, workers = 1, threads = None, preload = None):
+    sock = bind_socket(host, port)
+    if preload is not None:
+        # 在父进程中加载模型，fork 后各 worker 以写时复制的方式共享只读权重
+        torch.set_grad_enabled(False)
+        preload()
+    gc.collect()
+    gc.freeze() # 避免子进程的垃圾回收触碰共享对象导致页面复制
+    threads = split_threads(workers, threads)
+    state_path = tempfile.mkdtemp(prefix = "stt-workers-")
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for index in range(workers):
+        process = context.Process(target = run_worker, args = (app, sock, threads, index, workers, state_path), 
+                                  daemon = False)
+        process.start()
+        processes.append(process)
+    logger.info(f"[Workers] {workers} workers listening on {host}:{port}")
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for process in processes:
+        process.join()
+    sock.close()
+    shutil.rmtree(state_path, ignore_errors = True)